@@ -20,11 +20,28 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import hashlib
+from types import MappingProxyType
 import streamlit as st
 import services.models_response as models_response
-import sqlite3
 import services.database as db_service
 
+try:
+    import pybase64 as base64  # SIMD-accelerated, same API as the stdlib module
+except ImportError:
+    import base64
+
+# Model key -> label shown in the model selectbox, taken from the models service so a
+# model added there shows up here too
+MODEL_LABELS = MappingProxyType({
+    key: spec.label for key, spec in models_response.ModelsData.MODELS.items()
+})
+MODEL_IDS = list(MODEL_LABELS)
+# Models whose chats offer the image uploader
+IMAGE_MODEL_IDS = frozenset(
+    key for key, spec in models_response.ModelsData.MODELS.items() if spec.accepts_images
+)
+
 # --- PAGE CONFIGURATION ---
 st.set_page_config(
     page_title="Chat for free API",
@@ -37,31 +54,77 @@ st.title("🤖 Chat for free API")
 # st.caption("A chat interface built with Streamlit")
 
 # --- INITIALIZE DATABASE ---
-db_service.initialize_database()
+@st.cache_resource(show_spinner=False)
+def init_database():
+    """Creates the schema and opens the connection pool once per server process."""
+    db_service.initialize_database()
+
+init_database()
+
+@st.cache_data(show_spinner=False)
+def default_user_id() -> int:
+    """Returns the ID of the default user, looked up (or created) once per server process."""
+    return db_service.get_user_id("default_user")
+
+@st.cache_data(show_spinner=False)
+def cached_role_by_id(role_id: int):
+    """Returns a role (dict) by its ID; cleared whenever a role is created."""
+    role = db_service.get_role_by_id(role_id)
+    # st.cache_data pickles its results, which sqlite3.Row doesn't support
+    return dict(role) if role else None
+
+@st.cache_data(show_spinner=False)
+def sidebar_roles(user_id: int):
+    """
+    Returns the user's roles (dicts) together with their selectbox labels and IDs,
+    so the labels are only formatted again after a role is created.
+    """
+    roles = [dict(r) for r in db_service.get_roles_by_user(user_id)]
+    role_options = [f"{r['name']} - {r['description'][:20]}..." if r['description'] else r['name'] for r in roles]
+    role_ids = [r['role_id'] for r in roles]
+    return roles, role_options, role_ids
 
 # --- LOAD HISTORY IF EXISTS ---
-if "chat_history" not in st.session_state or not st.session_state["chat_history"]:
-    user_id = db_service.get_user_id("default_user")
-    conversations = db_service.get_conversations_by_user(user_id)
-    st.session_state.chat_history = {}
+def load_history(user_id: int):
+    """
+    Reads the user's conversations and their titles from the database.
+    Returns (chat_history, chat_titles, conversation_id_map, role_id_map), keyed by
+    chat number. Message lists start as None and are loaded when a chat is opened.
+    """
+    chat_history = {}
+    chat_titles = {}
     conversation_id_map = {}
     role_id_map = {}
-    for idx, conv in enumerate(conversations):
-        conv_id = conv["conversation_id"]
-        messages = db_service.get_messages_by_conversation(conv_id)
-        st.session_state.chat_history[idx+1] = messages
-        conversation_id_map[idx+1] = conv_id
-        role_id_map[idx+1] = conv.get("role_id")
-    if conversations:
+    for idx, conv in enumerate(db_service.get_chat_titles(user_id)):
+        chat_history[idx+1] = None
+        chat_titles[idx+1] = conv["title"]
+        conversation_id_map[idx+1] = conv["conversation_id"]
+        role_id_map[idx+1] = conv["role_id"]
+    return chat_history, chat_titles, conversation_id_map, role_id_map
+
+# Only once per session: afterwards new chats and messages are appended to
+# session_state directly, so the database never needs to be re-read on a rerun
+if "_history_loaded" not in st.session_state:
+    (st.session_state.chat_history,
+     st.session_state.chat_titles,
+     st.session_state.conversation_id_map,
+     st.session_state.role_id_map) = load_history(default_user_id())
+    st.session_state._history_loaded = True
+    if st.session_state.chat_history:
         st.session_state.current_chat_id = 1
-        st.session_state.chat_id_counter = len(conversations)
-        st.session_state.current_db_conversation_id = conversation_id_map[1]
-        st.session_state.current_role_id = role_id_map[1]
+        st.session_state.chat_id_counter = len(st.session_state.chat_history)
+        st.session_state.current_db_conversation_id = st.session_state.conversation_id_map[1]
+        st.session_state.current_role_id = st.session_state.role_id_map[1]
 
 # --- SESSION STATE ---
 if "chat_history" not in st.session_state:
     st.session_state.chat_history = {}
 
+# Chat number -> sidebar title / database conversation_id / role_id
+st.session_state.setdefault("chat_titles", {})
+st.session_state.setdefault("conversation_id_map", {})
+st.session_state.setdefault("role_id_map", {})
+
 if "current_chat_id" not in st.session_state:
     st.session_state.current_chat_id = None
 
@@ -75,15 +138,13 @@ if "current_role_id" not in st.session_state:
 models_data = models_response.ModelsData()
 
 # --- HELPER FUNCTIONS ---
-def get_deepseek_response(message: str, system_message: str = None) -> str:
+def stream_model_response(message: str, system_message: str = None):
     """
-    Sends a message to the selected model via OpenRouter and returns the response.
+    Streams the selected model's response via OpenRouter, chunk by chunk.
     If system_message is provided, it is sent as a system prompt.
     """
-    if modelo_seleccionado == "gemini_flash":
-        return models_data.gemini_flash(message, image_url=image_data_url if image_data_url else None, system_message=system_message)
-    else:
-        return models_data.get_response(message, modelo_seleccionado, system_message=system_message)
+    image_url = image_data_url if modelo_seleccionado in IMAGE_MODEL_IDS else None
+    return models_data.stream_response(message, modelo_seleccionado, system_message=system_message, image_url=image_url)
 
 
 def create_new_chat():
@@ -93,20 +154,17 @@ def create_new_chat():
     st.session_state.chat_history[new_id] = []
     st.session_state.current_chat_id = new_id
 
-    # Start conversation in the database
-    conn = sqlite3.connect(db_service.DATABASE_FILE)
-    try:
-        cursor = conn.cursor()
-        user_id = db_service.get_user_id("default_user")  # No authentication yet
-        role_id = st.session_state.current_role_id
+    # Start conversation in the database, in a single transaction
+    user_id = default_user_id()  # No authentication yet
+    role_id = st.session_state.current_role_id
+    with db_service.database_transaction() as cursor:
         conversation_id = db_service.create_conversation(user_id, cursor=cursor)
         if role_id:
-            db_service.assign_role_to_conversation(conversation_id, role_id)
-        st.session_state.current_db_conversation_id = conversation_id
+            db_service.assign_role_to_conversation(conversation_id, role_id, cursor=cursor)
         db_service.log_action("New chat started", f"User ID: {user_id}, Role ID: {role_id}", cursor=cursor)
-        conn.commit()
-    finally:
-        conn.close()
+    st.session_state.current_db_conversation_id = conversation_id
+    st.session_state.conversation_id_map[new_id] = conversation_id
+    st.session_state.role_id_map[new_id] = role_id
 
 # --- SIDEBAR ---
 
@@ -116,10 +174,9 @@ with st.sidebar:
         create_new_chat()
 
     st.subheader("Roles (Persona/Context)")
-    user_id = db_service.get_user_id("default_user")
-    roles = db_service.get_roles_by_user(user_id)
-    role_options = [f"{r['name']} - {r['description'][:20]}..." if r['description'] else r['name'] for r in roles]
-    role_ids = [r['role_id'] for r in roles]
+    user_id = default_user_id()
+    roles, role_options, role_ids = sidebar_roles(user_id)
+    roles_by_id = {r['role_id']: r for r in roles}
     if roles:
         selected_role_idx = st.selectbox("Select a role for this chat", list(range(len(roles))), format_func=lambda i: role_options[i], key="role_select")
         st.session_state.current_role_id = role_ids[selected_role_idx]
@@ -133,22 +190,14 @@ with st.sidebar:
         if st.button("Create role", key="create_role_btn"):
             if new_role_name and new_role_desc:
                 db_service.create_role(user_id, new_role_name, new_role_desc)
+                cached_role_by_id.clear()
+                sidebar_roles.clear()
                 st.experimental_rerun()
             else:
                 st.warning("Please provide both a name and a description.")
 
     st.subheader("Select model")
-    modelo_seleccionado = st.selectbox(
-        "Model",
-        ["deepseek_v3", "kimi", "gemini_flash", "qwq_32b", "mistral_nemo"],
-        format_func=lambda x: {
-            "deepseek_v3": "DeepSeek v3",
-            "kimi": "Kimi",
-            "gemini_flash": "Gemini 2.0 Flash",
-            "qwq_32b": "Qwen QWQ-32B",
-            "mistral_nemo": "Mistral Nemo"
-        }[x]
-    )
+    modelo_seleccionado = st.selectbox("Model", MODEL_IDS, format_func=MODEL_LABELS.__getitem__)
     # No image URL field in the sidebar anymore
 
     st.subheader("History")
@@ -159,26 +208,31 @@ with st.sidebar:
         chat_title = f"Chat {chat_id}"
         if messages:
             chat_title = messages[0]["content"][:30] + "..."
+        elif st.session_state.chat_titles.get(chat_id):
+            # Not opened yet in this session: use the title read from the database
+            chat_title = st.session_state.chat_titles[chat_id] + "..."
 
         # Button to switch to the selected chat
         if st.button(chat_title, key=f"switch_{chat_id}", use_container_width=True):
             st.session_state.current_chat_id = chat_id
-            if "conversation_id_map" in locals():
-                st.session_state.current_db_conversation_id = conversation_id_map[chat_id]
-            if "role_id_map" in locals():
-                st.session_state.current_role_id = role_id_map[chat_id]
+            st.session_state.current_db_conversation_id = st.session_state.conversation_id_map[chat_id]
+            st.session_state.current_role_id = st.session_state.role_id_map[chat_id]
 
 # --- MAIN CHAT LOGIC ---
 
 if st.session_state.current_chat_id is None:
     st.info("Select a chat or create a new one to start.")
 else:
-    # Show messages of the current chat
+    # Show messages of the current chat, loading them the first time it is opened
     current_messages = st.session_state.chat_history[st.session_state.current_chat_id]
+    if current_messages is None:
+        current_messages = db_service.get_messages_by_conversation(st.session_state.current_db_conversation_id)
+        st.session_state.chat_history[st.session_state.current_chat_id] = current_messages
     # Get current system prompt (role description)
     system_message = None
     if st.session_state.current_role_id:
-        role_info = db_service.get_role_by_id(st.session_state.current_role_id)
+        # The sidebar already loaded the user's roles; only fall back to a lookup if it's missing
+        role_info = roles_by_id.get(st.session_state.current_role_id) or cached_role_by_id(st.session_state.current_role_id)
         if role_info:
             system_message = role_info["description"]
     for message in current_messages:
@@ -187,13 +241,20 @@ else:
 
     # User input at the bottom of the page
     image_bytes = None
-    if modelo_seleccionado == "gemini_flash":
+    if modelo_seleccionado in IMAGE_MODEL_IDS:
         uploaded_file = st.file_uploader("Upload an image (optional)", type=["png", "jpg", "jpeg"], key="image_uploader")
         if uploaded_file is not None:
-            import base64
-            image_bytes = uploaded_file.read()
-            image_b64 = base64.b64encode(image_bytes).decode("utf-8")
-            image_data_url = f"data:image/{uploaded_file.type.split('/')[-1]};base64,{image_b64}"
+            image_bytes = uploaded_file.getvalue()
+            # Encoding a large image on every rerun is expensive, so keep the data URL of
+            # the last upload and only re-encode when a different file comes in
+            image_key = hashlib.blake2b(image_bytes, digest_size=8).digest()
+            cached_key, cached_url = st.session_state.get("_img_cache", (None, None))
+            if cached_key == image_key:
+                image_data_url = cached_url
+            else:
+                image_b64 = base64.b64encode(image_bytes).decode("utf-8")
+                image_data_url = f"data:image/{uploaded_file.type.split('/')[-1]};base64,{image_b64}"
+                st.session_state["_img_cache"] = (image_key, image_data_url)
         else:
             image_data_url = None
     else:
@@ -204,29 +265,23 @@ else:
         current_messages.append({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
-            if modelo_seleccionado == "gemini_flash" and image_data_url:
+            if modelo_seleccionado in IMAGE_MODEL_IDS and image_data_url:
                 st.image(image_bytes, caption="Image sent", use_column_width=True)
 
-        # Save the user's message in the database
-        conn = sqlite3.connect(db_service.DATABASE_FILE)
-        try:
-            cursor = conn.cursor()
+        # Generate and show the assistant's response
+        response = None
+        with st.chat_message("assistant"):
+            try:
+                # Render tokens as they arrive; write_stream returns the full text
+                response = st.write_stream(stream_model_response(prompt, system_message=system_message))
+                # Add the assistant's response to the history
+                current_messages.append({"role": "assistant", "content": response})
+            except Exception as e:
+                st.error(f"An unexpected error occurred: {e}")
+
+        # Save the whole turn in a single transaction. The model call stays outside it
+        # so the write lock is not held while waiting on the network.
+        with db_service.database_transaction() as cursor:
             db_service.add_message(st.session_state.current_db_conversation_id, "user", prompt, "user_input", cursor=cursor)
-            # Generate and show the assistant's response
-            with st.chat_message("assistant"):
-                with st.spinner("Thinking..."):
-                    try:
-                        if modelo_seleccionado == "gemini_flash":
-                            response = models_data.gemini_flash(prompt, image_url=image_data_url, system_message=system_message)
-                        else:
-                            response = get_deepseek_response(prompt, system_message=system_message)
-                        st.markdown(response)
-                        # Save the assistant's response in the database
-                        db_service.add_message(st.session_state.current_db_conversation_id, "assistant", response, "deepseekchimera", cursor=cursor)
-                        # Add the assistant's response to the history
-                        current_messages.append({"role": "assistant", "content": response})
-                    except Exception as e:
-                        st.error(f"An unexpected error occurred: {e}")
-            conn.commit()
-        finally:
-            conn.close()
\ No newline at end of file
+            if response is not None:
+                db_service.add_message(st.session_state.current_db_conversation_id, "assistant", response, "deepseekchimera", cursor=cursor)
@@ -21,107 +21,359 @@
 # SOFTWARE.
 
 import sqlite3
-import json
+import logging
+import queue
+import random
 import threading
 import time
-from datetime import datetime
 from contextlib import contextmanager
 from typing import Optional, Generator
 
+logger = logging.getLogger(__name__)
+
 DATABASE_FILE = "chat_history.db"
+READ_POOL_SIZE = 4
+# Prepared statements kept per pooled connection, keyed by SQL text (sqlite3 default: 128)
+STATEMENT_CACHE_SIZE = 256
+# NORMAL is crash-safe under WAL but a power loss may drop the last commits;
+# set to "FULL" before the first connection is opened to fsync on every commit
+SYNCHRONOUS = "NORMAL"
+
+# Bump SCHEMA_VERSION whenever SCHEMA_SQL changes; initialize_database skips the
+# script entirely when PRAGMA user_version already matches. Every statement must be
+# idempotent because older databases run the whole script again.
+SCHEMA_VERSION = 5
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS roles (
+    role_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    description TEXT,
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS conversations (
+    conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    start_time DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    role_id INTEGER,
+    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
+    FOREIGN KEY (role_id) REFERENCES roles (role_id) ON DELETE SET NULL
+);
+
+CREATE TABLE IF NOT EXISTS messages (
+    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    conversation_id INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    model TEXT NOT NULL,
+    timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),  -- Unix seconds (UTC)
+    FOREIGN KEY (conversation_id) REFERENCES conversations (conversation_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS logs (
+    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    timestamp INTEGER NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),  -- Unix seconds (UTC)
+    action TEXT NOT NULL,
+    details TEXT
+);
+
+-- Indexes for better performance
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE INDEX IF NOT EXISTS idx_roles_user_id ON roles(user_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_start_time ON conversations(start_time);
+CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp);
+-- Indexes matching the history queries' WHERE + ORDER BY, so SQLite walks them in
+-- order instead of sorting. The implicit trailing rowid covers the ordering by
+-- message_id and the conversation_id tiebreak.
+CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id);
+CREATE INDEX IF NOT EXISTS idx_conversations_user_time ON conversations(user_id, start_time);
+-- v2: superseded by the composite index above
+DROP INDEX IF EXISTS idx_conversations_user_id;
+-- v3: messages are ordered by message_id, so the timestamp indexes are unused
+DROP INDEX IF EXISTS idx_messages_conv_ts;
+DROP INDEX IF EXISTS idx_messages_timestamp;
+-- v4: message and log timestamps are INTEGER Unix seconds instead of ISO-8601 text.
+-- Older files keep their DATETIME column declaration, which stores integers as-is.
+-- Values from datetime.now().isoformat() ('T' separator) are local time, hence 'utc';
+-- CURRENT_TIMESTAMP values (space separator) are UTC already.
+UPDATE messages SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE typeof(timestamp) = 'text' AND timestamp LIKE '%T%';
+UPDATE messages SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) WHERE typeof(timestamp) = 'text';
+UPDATE logs SET timestamp = CAST(strftime('%s', timestamp, 'utc') AS INTEGER) WHERE typeof(timestamp) = 'text' AND timestamp LIKE '%T%';
+UPDATE logs SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) WHERE typeof(timestamp) = 'text';
+-- v5: conversation start times written by datetime.now().isoformat() (local time, 'T'
+-- separator) become UTC 'YYYY-MM-DD HH:MM:SS' like CURRENT_TIMESTAMP, so both sort together.
+UPDATE conversations SET start_time = datetime(start_time, 'utc') WHERE start_time LIKE '%T%';
+"""
+
+# SQL statements used by the helpers below. Keeping each one in a single module-level
+# string passes the same object on every call to the connection's statement cache
+# (STATEMENT_CACHE_SIZE), and keeps the queries in one place.
+_SQL_INSERT_ROLE = "INSERT INTO roles (user_id, name, description) VALUES (?, ?, ?)"
+_SQL_SELECT_ROLES_BY_USER = "SELECT role_id, name, description FROM roles WHERE user_id = ?"
+_SQL_SELECT_ROLE = "SELECT role_id, name, description FROM roles WHERE role_id = ?"
+_SQL_UPDATE_CONVERSATION_ROLE = "UPDATE conversations SET role_id = ? WHERE conversation_id = ?"
+_SQL_SELECT_USER_ID = "SELECT user_id FROM users WHERE username = ?"
+_SQL_INSERT_USER = "INSERT INTO users (username) VALUES (?)"
+_SQL_INSERT_CONVERSATION = "INSERT INTO conversations (user_id, start_time) VALUES (?, CURRENT_TIMESTAMP)"
+# Written explicitly rather than left to the column default, which files created
+# before v4 still have as CURRENT_TIMESTAMP text
+_SQL_INSERT_MESSAGE = "INSERT INTO messages (conversation_id, role, content, model, timestamp) VALUES (?, ?, ?, ?, CAST(strftime('%s', 'now') AS INTEGER))"
+_SQL_LAST_INSERT_ROWID = "SELECT last_insert_rowid()"
+_SQL_INSERT_LOG = "INSERT INTO logs (timestamp, action, details) VALUES (CAST(strftime('%s', 'now') AS INTEGER), ?, ?)"
+_SQL_SELECT_MESSAGES = "SELECT role, content, model, timestamp FROM messages WHERE conversation_id = ? ORDER BY message_id ASC"
+_SQL_SELECT_MESSAGES_PAGE = (
+    "SELECT message_id, role, content, model, timestamp FROM messages "
+    "WHERE conversation_id = ? AND message_id > ? ORDER BY message_id ASC LIMIT ?"
+)
+_SQL_SELECT_CHAT_TITLES = (
+    "SELECT c.conversation_id, c.role_id, "
+    "(SELECT SUBSTR(m.content, 1, 30) FROM messages m "
+    "WHERE m.conversation_id = c.conversation_id AND m.role = 'user' "
+    "ORDER BY m.message_id ASC LIMIT 1) AS title "
+    "FROM conversations c WHERE c.user_id = ? "
+    "ORDER BY c.start_time DESC, c.conversation_id DESC"
+)
+
+# Connection pool: a single long-lived read-write connection (SQLite only allows one
+# writer at a time anyway) plus a queue of read-only connections for the helpers that
+# only SELECT. Connections are opened lazily and reused across Streamlit reruns.
+_write_conn: Optional["_PooledConnection"] = None
+_write_lock = threading.Lock()
+_read_pool: "queue.Queue[_PooledConnection]" = queue.Queue()
+_read_pool_filled = False
+_pool_init_lock = threading.Lock()
+
+# Retries for SQLITE_BUSY in database_transaction. Lock waits are normally absorbed by
+# SQLite's own busy handler (the connection timeout, i.e. PRAGMA busy_timeout), so an
+# error only reaches Python after that wait ran out or in the cases SQLite won't wait
+# on (e.g. a stale WAL snapshot). Delays are jittered so that connections that
+# collided don't all wake up and collide again.
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 0.001  # seconds
+RETRY_MAX_DELAY = 0.1     # seconds
+_SQLITE_BUSY = 5
+_retry_rng = threading.local()
+
+def _stripped(value, field: str) -> str:
+    """Validates a required text argument and returns it stripped, so it is cleaned once at the API boundary."""
+    if not isinstance(value, str) or not (value := value.strip()):
+        raise ValueError(f"{field} must be a non-empty string")
+    return value
+
+
+class _PooledConnection(sqlite3.Connection):
+    """sqlite3.Connection that can remember per-connection state between transactions."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_uncommitted = False  # SQLite's default
+        # Log rows queued by log_action/log_actions inside a write transaction on this
+        # connection; DatabaseConnection writes them with one executemany before COMMIT
+        self.pending_logs: list[tuple[str, str]] = []
+
+
+def _configure_connection(conn: sqlite3.Connection, read_only: bool = False):
+    """Applies the connection-level PRAGMAs once, when the connection is opened."""
+    if not read_only:
+        conn.execute("PRAGMA journal_mode=WAL")  # Write-Ahead Logging (persisted in the file)
+    conn.execute(f"PRAGMA synchronous={SYNCHRONOUS}")  # See SYNCHRONOUS above
+    conn.execute("PRAGMA foreign_keys=ON")        # Enable foreign key constraints
+    conn.execute("PRAGMA temp_store=MEMORY")      # Store temp tables in memory
+    conn.execute("PRAGMA mmap_size=268435456")    # Memory-map up to 256 MiB of the file
+    conn.execute("PRAGMA cache_size=-64000")      # ~64 MB page cache per connection
+    # Each pool gets the isolation level its helpers ask for (readers READ_UNCOMMITTED,
+    # the writer SERIALIZABLE), so transactions normally never have to switch it
+    if read_only:
+        conn.execute("PRAGMA read_uncommitted=1")
+        conn.read_uncommitted = True
+    # Rows support both row[0] and row["column"] without building a dict per row
+    conn.row_factory = sqlite3.Row
+
+
+def _get_write_conn(timeout: int = 30) -> sqlite3.Connection:
+    """Returns the shared read-write connection, opening it on first use."""
+    global _write_conn
+    if _write_conn is None:
+        with _pool_init_lock:
+            if _write_conn is None:
+                conn = sqlite3.connect(
+                    DATABASE_FILE,
+                    timeout=timeout,  # Sets busy_timeout: SQLite itself waits out other writers
+                    isolation_level=None,  # We'll manage transactions manually
+                    check_same_thread=False,
+                    cached_statements=STATEMENT_CACHE_SIZE,
+                    factory=_PooledConnection
+                )
+                _configure_connection(conn)
+                _write_conn = conn
+    return _write_conn
+
+
+def _fill_read_pool(timeout: int = 30):
+    """Opens the read-only connections. The database file must already exist."""
+    global _read_pool_filled
+    # Opening the writer first creates the file and switches it to WAL
+    _get_write_conn(timeout)
+    with _pool_init_lock:
+        if _read_pool_filled:
+            return
+        for _ in range(READ_POOL_SIZE):
+            conn = sqlite3.connect(
+                f"file:{DATABASE_FILE}?mode=ro",
+                uri=True,
+                timeout=timeout,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=STATEMENT_CACHE_SIZE,
+                factory=_PooledConnection
+            )
+            _configure_connection(conn, read_only=True)
+            _read_pool.put(conn)
+        _read_pool_filled = True
+
+
+def _acquire_read_conn(timeout: int = 30) -> sqlite3.Connection:
+    """Takes a read-only connection from the pool, blocking until one is free."""
+    if not _read_pool_filled:
+        _fill_read_pool(timeout)
+    return _read_pool.get()
 
 
 class DatabaseConnection:
-    """ACID-compliant database connection with explicit transaction management."""
+    """ACID-compliant database transaction on a pooled connection."""
     
-    def __init__(self, isolation_level: str = "SERIALIZABLE", timeout: int = 30):
+    def __init__(self, isolation_level: str = "SERIALIZABLE", timeout: int = 30, read_only: bool = False,
+                 mode: Optional[str] = None):
         self.conn = None
         self.isolation_level = isolation_level
         self.timeout = timeout
-        self._lock = threading.Lock()
+        self.read_only = read_only
+        # Reads start DEFERRED so they only take a read snapshot and run alongside the
+        # writer under WAL; writes start IMMEDIATE to take the write lock up front
+        self.mode = mode or ("DEFERRED" if read_only else "IMMEDIATE")
         self._transaction_started = False
 
     def __enter__(self):
+        if self.read_only:
+            self.conn = _acquire_read_conn(self.timeout)
+        else:
+            # Only one transaction at a time may use the shared write connection
+            _write_lock.acquire()
         try:
-            with self._lock:
-                self.conn = sqlite3.connect(
-                    DATABASE_FILE, 
-                    timeout=self.timeout,
-                    isolation_level=None  # We'll manage transactions manually
-                )
-                
-                # Configure SQLite for ACID compliance
-                self.conn.execute("PRAGMA journal_mode=WAL")  # Write-Ahead Logging
-                self.conn.execute("PRAGMA synchronous=FULL")  # Full synchronization
-                self.conn.execute("PRAGMA foreign_keys=ON")   # Enable foreign key constraints
-                self.conn.execute("PRAGMA temp_store=MEMORY") # Store temp tables in memory
-                
-                # Set isolation level
-                if self.isolation_level == "READ_UNCOMMITTED":
-                    self.conn.execute("PRAGMA read_uncommitted=1")
-                else:  # SERIALIZABLE (default)
-                    self.conn.execute("PRAGMA read_uncommitted=0")
-                
-                # Start explicit transaction
-                self.conn.execute("BEGIN IMMEDIATE TRANSACTION")
-                self._transaction_started = True
-                
-                return self.conn.cursor()
+            if not self.read_only:
+                self.conn = _get_write_conn(self.timeout)
+
+            # Set isolation level, only when it differs from the one the pool was opened with
+            read_uncommitted = self.isolation_level == "READ_UNCOMMITTED"  # else SERIALIZABLE (default)
+            if self.conn.read_uncommitted != read_uncommitted:
+                self.conn.execute(f"PRAGMA read_uncommitted={int(read_uncommitted)}")
+                self.conn.read_uncommitted = read_uncommitted
+            
+            # Start explicit transaction
+            self.conn.execute(f"BEGIN {self.mode} TRANSACTION")
+            self._transaction_started = True
+            
+            return self.conn.cursor()
                 
         except sqlite3.Error as e:
-            if self.conn:
-                self.conn.close()
-            print(f"Database connection error: {e}")
+            self._release()
+            logger.error("Database connection error: %s", e)
             raise e
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.conn and self._transaction_started:
-            try:
-                with self._lock:
-                    if exc_type is None:
-                        # Success - commit transaction
-                        self.conn.execute("COMMIT")
-                        print("Transaction committed successfully")
-                    else:
-                        # Exception occurred - rollback transaction
+            if exc_type is None and not self.read_only and self.conn.pending_logs:
+                # Kept out of the try below, which only logs COMMIT errors: if the queued
+                # log rows can't be written, the caller must see the transaction fail
+                try:
+                    self.conn.executemany(_SQL_INSERT_LOG, self.conn.pending_logs)
+                except sqlite3.Error as e:
+                    logger.error("Error writing queued log rows, rolling back: %s", e)
+                    try:
                         self.conn.execute("ROLLBACK")
-                        print(f"Transaction rolled back due to: {exc_type.__name__}")
+                    except sqlite3.Error:
+                        pass
+                    self._transaction_started = False
+                    self._release()
+                    raise
+            try:
+                if exc_type is None:
+                    # Success - commit transaction
+                    self.conn.execute("COMMIT")
+                    logger.debug("Transaction committed successfully")
+                else:
+                    # Exception occurred - rollback transaction
+                    self.conn.execute("ROLLBACK")
+                    logger.warning("Transaction rolled back due to: %s", exc_type.__name__)
                         
             except sqlite3.Error as e:
-                print(f"Database error during transaction cleanup: {e}")
+                logger.error("Database error during transaction cleanup: %s", e)
                 # Force rollback if commit/rollback fails
                 try:
                     self.conn.execute("ROLLBACK")
                 except:
                     pass
             finally:
-                self.conn.close()
                 self._transaction_started = False
+                self._release()
+
+    def _release(self):
+        """Returns the connection to the pool; pooled connections are never closed."""
+        if self.read_only:
+            if self.conn is not None:
+                _read_pool.put(self.conn)
+        else:
+            # Queued log rows never outlive the transaction that queued them
+            if self.conn is not None:
+                self.conn.pending_logs.clear()
+            _write_lock.release()
+        self.conn = None
+
+
+def _is_busy_error(e: sqlite3.OperationalError) -> bool:
+    """True if the error is SQLITE_BUSY (database locked by another connection)."""
+    code = getattr(e, "sqlite_errorcode", None)  # Python 3.11+
+    if code is not None:
+        return code & 0xFF == _SQLITE_BUSY  # Also matches extended codes like SQLITE_BUSY_SNAPSHOT
+    return "database is locked" in str(e).lower()
+
+
+def _retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2**attempt)]."""
+    # One Random per thread so concurrent retries don't contend on the global RNG lock
+    rng = getattr(_retry_rng, "rng", None)
+    if rng is None:
+        rng = _retry_rng.rng = random.Random()
+    return rng.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
 
 
 @contextmanager
-def database_transaction(isolation_level: str = "SERIALIZABLE", timeout: int = 30) -> Generator[sqlite3.Cursor, None, None]:
+def database_transaction(isolation_level: str = "SERIALIZABLE", timeout: int = 30, read_only: bool = False,
+                         mode: Optional[str] = None) -> Generator[sqlite3.Cursor, None, None]:
     """Context manager for ACID-compliant database transactions with retry logic."""
-    max_retries = 3
-    retry_delay = 0.1
-    
-    for attempt in range(max_retries):
+    for attempt in range(MAX_RETRIES):
         try:
-            with DatabaseConnection(isolation_level, timeout) as cursor:
+            with DatabaseConnection(isolation_level, timeout, read_only, mode) as cursor:
                 yield cursor
                 return  # Success, exit retry loop
                 
         except sqlite3.OperationalError as e:
-            if "database is locked" in str(e).lower() and attempt < max_retries - 1:
-                print(f"Database locked, retrying in {retry_delay}s (attempt {attempt + 1}/{max_retries})")
-                time.sleep(retry_delay)
-                retry_delay *= 2  # Exponential backoff
+            if _is_busy_error(e) and attempt < MAX_RETRIES - 1:
+                delay = _retry_delay(attempt)
+                logger.warning("Database locked, retrying in %.4fs (attempt %s/%s)", delay, attempt + 1, MAX_RETRIES)
+                time.sleep(delay)
                 continue
             else:
-                print(f"Database operational error: {e}")
+                logger.error("Database operational error: %s", e)
                 raise e
         except Exception as e:
-            print(f"Unexpected database error: {e}")
+            logger.error("Unexpected database error: %s", e)
             raise e
     
     raise sqlite3.OperationalError("Max retries exceeded for database transaction")
@@ -129,78 +381,28 @@ def database_transaction(isolation_level: str = "SERIALIZABLE", timeout: int = 3
 
 def initialize_database():
     """Initializes the SQLite database and creates tables if they don't exist."""
-    try:
-        with database_transaction() as cursor:
-            # Create tables if they don't exist
-            tables = [
-                """
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL
-                )
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS roles (
-                    role_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    name TEXT NOT NULL,
-                    description TEXT,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE
-                )
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS conversations (
-                    conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    start_time DATETIME NOT NULL,
-                    role_id INTEGER,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE,
-                    FOREIGN KEY (role_id) REFERENCES roles (role_id) ON DELETE SET NULL
-                )
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    conversation_id INTEGER NOT NULL,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    model TEXT NOT NULL,
-                    timestamp DATETIME NOT NULL,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (conversation_id) ON DELETE CASCADE
-                )
-                """,
-                """
-                CREATE TABLE IF NOT EXISTS logs (
-                    log_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    timestamp DATETIME NOT NULL,
-                    action TEXT NOT NULL,
-                    details TEXT
-                )
-                """
-            ]
-            
-            for table_sql in tables:
-                cursor.execute(table_sql)
-            
-            # Create indexes for better performance
-            indexes = [
-                "CREATE INDEX IF NOT EXISTS idx_users_username ON users(username)",
-                "CREATE INDEX IF NOT EXISTS idx_roles_user_id ON roles(user_id)",
-                "CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id)",
-                "CREATE INDEX IF NOT EXISTS idx_conversations_start_time ON conversations(start_time)",
-                "CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id)",
-                "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages(timestamp)",
-                "CREATE INDEX IF NOT EXISTS idx_logs_timestamp ON logs(timestamp)"
-            ]
-            
-            for index_sql in indexes:
-                cursor.execute(index_sql)
-            
-            print("Database initialized successfully with ACID compliance")
-            
-    except Exception as e:
-        print(f"Error during database initialization: {e}")
-        raise e
+    with _write_lock:
+        conn = _get_write_conn()
+        try:
+            # Nothing to do once the file is already at the current schema version
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+                return
+
+            # executescript commits any open transaction before running, so the
+            # script carries its own BEGIN/COMMIT to stay atomic
+            conn.executescript(
+                "BEGIN IMMEDIATE TRANSACTION;"
+                + SCHEMA_SQL
+                + f"PRAGMA user_version = {SCHEMA_VERSION};"
+                + "COMMIT;"
+            )
+            logger.info("Database initialized successfully with ACID compliance")
+
+        except Exception as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            logger.error("Error during database initialization: %s", e)
+            raise e
 
 
 def create_role(user_id: int, name: str, description: str) -> int:
@@ -208,68 +410,58 @@ def create_role(user_id: int, name: str, description: str) -> int:
     # Input validation
     if not isinstance(user_id, int) or user_id <= 0:
         raise ValueError("user_id must be a positive integer")
-    if not isinstance(name, str) or not name.strip():
-        raise ValueError("name must be a non-empty string")
+    name = _stripped(name, "name")
     if not isinstance(description, str):
         raise ValueError("description must be a string")
     
     try:
         with database_transaction() as cursor:
-            # Check if user exists with row-level locking
-            cursor.execute("SELECT user_id FROM users WHERE user_id = ? FOR UPDATE", (user_id,))
-            if not cursor.fetchone():
+            # The foreign key on user_id rejects unknown users
+            try:
+                cursor.execute(_SQL_INSERT_ROLE, (user_id, name, description))
+            except sqlite3.IntegrityError:
                 raise ValueError(f"User with ID {user_id} does not exist")
-            
-            # Insert role with proper locking
-            cursor.execute("INSERT INTO roles (user_id, name, description) VALUES (?, ?, ?)", 
-                          (user_id, name.strip(), description))
             role_id = cursor.lastrowid
             
             if role_id is None:
                 raise sqlite3.Error("Failed to create role - no ID returned")
             
-            print(f"Role created successfully with ID: {role_id}")
+            logger.debug("Role created successfully with ID: %s", role_id)
             return role_id
             
     except Exception as e:
-        print(f"Error creating role: {e}")
+        logger.error("Error creating role: %s", e)
         raise e
 
 def get_roles_by_user(user_id: int):
-    """Returns a list of roles (dict) for a given user."""
+    """Returns a list of roles (sqlite3.Row) for a given user."""
     # Input validation
     if not isinstance(user_id, int) or user_id <= 0:
         raise ValueError("user_id must be a positive integer")
     
     try:
-        with database_transaction(isolation_level="READ_UNCOMMITTED") as cursor:
-            cursor.execute("SELECT role_id, name, description FROM roles WHERE user_id = ?", (user_id,))
-            rows = cursor.fetchall()
-            return [
-                {"role_id": row[0], "name": row[1], "description": row[2]} for row in rows
-            ]
+        with database_transaction(isolation_level="READ_UNCOMMITTED", read_only=True) as cursor:
+            cursor.execute(_SQL_SELECT_ROLES_BY_USER, (user_id,))
+            return cursor.fetchall()
     except Exception as e:
-        print(f"Error getting roles by user: {e}")
+        logger.error("Error getting roles by user: %s", e)
         raise e
 
 def get_role_by_id(role_id: int):
-    """Returns a role (dict) by its ID."""
+    """Returns a role (sqlite3.Row) by its ID, or None."""
     # Input validation
     if not isinstance(role_id, int) or role_id <= 0:
         raise ValueError("role_id must be a positive integer")
     
     try:
-        with database_transaction(isolation_level="READ_UNCOMMITTED") as cursor:
-            cursor.execute("SELECT role_id, name, description FROM roles WHERE role_id = ?", (role_id,))
-            row = cursor.fetchone()
-            if row:
-                return {"role_id": row[0], "name": row[1], "description": row[2]}
-            return None
+        with database_transaction(isolation_level="READ_UNCOMMITTED", read_only=True) as cursor:
+            cursor.execute(_SQL_SELECT_ROLE, (role_id,))
+            return cursor.fetchone()
     except Exception as e:
-        print(f"Error getting role by ID: {e}")
+        logger.error("Error getting role by ID: %s", e)
         raise e
 
-def assign_role_to_conversation(conversation_id: int, role_id: int):
+def assign_role_to_conversation(conversation_id: int, role_id: int, cursor=None):
     """Assigns a role to a conversation."""
     # Input validation
     if not isinstance(conversation_id, int) or conversation_id <= 0:
@@ -277,57 +469,58 @@ def assign_role_to_conversation(conversation_id: int, role_id: int):
     if not isinstance(role_id, int) or role_id <= 0:
         raise ValueError("role_id must be a positive integer")
     
+    if cursor is not None:
+        # Using provided cursor (within existing transaction)
+        _update_conversation_role(cursor, conversation_id, role_id)
+        return
+
     try:
-        with database_transaction() as cursor:
-            # Check if conversation exists with row-level locking
-            cursor.execute("SELECT conversation_id FROM conversations WHERE conversation_id = ? FOR UPDATE", (conversation_id,))
-            if not cursor.fetchone():
-                raise ValueError(f"Conversation with ID {conversation_id} does not exist")
-            
-            # Check if role exists with row-level locking
-            cursor.execute("SELECT role_id FROM roles WHERE role_id = ? FOR UPDATE", (role_id,))
-            if not cursor.fetchone():
-                raise ValueError(f"Role with ID {role_id} does not exist")
-            
-            cursor.execute("UPDATE conversations SET role_id = ? WHERE conversation_id = ?", (role_id, conversation_id))
-            
-            # Check if any rows were affected
-            if cursor.rowcount == 0:
-                raise ValueError(f"No conversation was updated. Conversation ID {conversation_id} may not exist")
-            
-            print(f"Role {role_id} assigned to conversation {conversation_id} successfully")
+        with database_transaction() as cur:
+            _update_conversation_role(cur, conversation_id, role_id)
+            logger.debug("Role %s assigned to conversation %s successfully", role_id, conversation_id)
             
     except Exception as e:
-        print(f"Error assigning role to conversation: {e}")
+        logger.error("Error assigning role to conversation: %s", e)
         raise e
 
 
+def _update_conversation_role(cursor, conversation_id: int, role_id: int):
+    """Sets a conversation's role using the caller's transaction."""
+    # The foreign key on role_id rejects unknown roles; an unknown conversation updates no rows
+    try:
+        cursor.execute(_SQL_UPDATE_CONVERSATION_ROLE, (role_id, conversation_id))
+    except sqlite3.IntegrityError:
+        raise ValueError(f"Role with ID {role_id} does not exist")
+    
+    if cursor.rowcount == 0:
+        raise ValueError(f"Conversation with ID {conversation_id} does not exist")
+
+
 def get_user_id(username: str) -> int:
     """Gets or creates a user and returns the user ID."""
     # Input validation
-    if not isinstance(username, str) or not username.strip():
-        raise ValueError("username must be a non-empty string")
+    username = _stripped(username, "username")
     
     try:
         with database_transaction() as cursor:
-            # Use row-level locking to prevent race conditions
-            cursor.execute("SELECT user_id FROM users WHERE username = ? FOR UPDATE", (username.strip(),))
+            # BEGIN IMMEDIATE already holds the write lock, so the lookup and insert can't race
+            cursor.execute(_SQL_SELECT_USER_ID, (username,))
             result = cursor.fetchone()
             if result:
                 return result[0]
             else:
-                cursor.execute("INSERT INTO users (username) VALUES (?)", (username.strip(),))
+                cursor.execute(_SQL_INSERT_USER, (username,))
                 user_id = cursor.lastrowid
                 
                 if user_id is None:
                     raise sqlite3.Error("Failed to create user - no ID returned")
                 
                 log_action("User created", f"Username: {username}, User ID: {user_id}", cursor)
-                print(f"User created successfully with ID: {user_id}")
+                logger.debug("User created successfully with ID: %s", user_id)
                 return user_id
                 
     except Exception as e:
-        print(f"Error getting/creating user: {e}")
+        logger.error("Error getting/creating user: %s", e)
         raise e
 
 
@@ -335,145 +528,247 @@ def get_user_id(username: str) -> int:
 
 
 
-def create_conversation(user_id: int) -> int:
+def create_conversation(user_id: int, cursor=None) -> int:
     """Creates a new conversation and returns the conversation ID."""
     # Input validation
     if not isinstance(user_id, int) or user_id <= 0:
         raise ValueError("user_id must be a positive integer")
     
-    now = datetime.now().isoformat()
-    
+    if cursor is not None:
+        # Using provided cursor (within existing transaction)
+        return _insert_conversation(cursor, user_id)
+
     try:
-        with database_transaction() as cursor:
-            # Check if user exists with row-level locking
-            cursor.execute("SELECT user_id FROM users WHERE user_id = ? FOR UPDATE", (user_id,))
-            if not cursor.fetchone():
-                raise ValueError(f"User with ID {user_id} does not exist")
-            
-            cursor.execute("INSERT INTO conversations (user_id, start_time) VALUES (?, ?)", (user_id, now))
-            conversation_id = cursor.lastrowid
-            
-            if conversation_id is None:
-                raise sqlite3.Error("Failed to create conversation - no ID returned")
-            
-            log_action("Conversation started", f"User ID: {user_id}, Conversation ID: {conversation_id}", cursor)
-            print(f"Conversation created successfully with ID: {conversation_id}")
+        with database_transaction() as cur:
+            conversation_id = _insert_conversation(cur, user_id)
+            logger.debug("Conversation created successfully with ID: %s", conversation_id)
             return conversation_id
             
     except Exception as e:
-        print(f"Error creating conversation: {e}")
+        logger.error("Error creating conversation: %s", e)
         raise e
 
 
+def _insert_conversation(cursor, user_id: int) -> int:
+    """Inserts a conversation and its log entry using the caller's transaction."""
+    # The foreign key on user_id rejects unknown users, no separate existence check needed
+    try:
+        cursor.execute(_SQL_INSERT_CONVERSATION, (user_id,))
+    except sqlite3.IntegrityError:
+        raise ValueError(f"User with ID {user_id} does not exist")
+    conversation_id = cursor.lastrowid
+    
+    if conversation_id is None:
+        raise sqlite3.Error("Failed to create conversation - no ID returned")
+    
+    log_action("Conversation started", f"User ID: {user_id}, Conversation ID: {conversation_id}", cursor)
+    return conversation_id
+
+
 
-def add_message(conversation_id: int, role: str, content: str, model: str) -> int:
+def add_message(conversation_id: int, role: str, content: str, model: str, cursor=None) -> int:
     """Adds a message to a conversation."""
     # Input validation
     if not isinstance(conversation_id, int) or conversation_id <= 0:
         raise ValueError("conversation_id must be a positive integer")
-    if not isinstance(role, str) or not role.strip():
-        raise ValueError("role must be a non-empty string")
+    role = _stripped(role, "role")
     if not isinstance(content, str):
         raise ValueError("content must be a string")
-    if not isinstance(model, str) or not model.strip():
-        raise ValueError("model must be a non-empty string")
-    
-    now = datetime.now().isoformat()
+    model = _stripped(model, "model")
     
+    if cursor is not None:
+        # Using provided cursor (within existing transaction)
+        return _insert_message(cursor, conversation_id, role, content, model)
+
     try:
-        with database_transaction() as cursor:
-            # Check if conversation exists with row-level locking
-            cursor.execute("SELECT conversation_id FROM conversations WHERE conversation_id = ? FOR UPDATE", (conversation_id,))
-            if not cursor.fetchone():
-                raise ValueError(f"Conversation with ID {conversation_id} does not exist")
-            
-            cursor.execute("INSERT INTO messages (conversation_id, role, content, model, timestamp) VALUES (?, ?, ?, ?, ?)", 
-                          (conversation_id, role.strip(), content, model.strip(), now))
-            
-            message_id = cursor.lastrowid
-            if message_id is None:
-                raise sqlite3.Error("Failed to add message - no ID returned")
-            
-            log_action("Message added", f"Conversation ID: {conversation_id}, Role: {role}, Model: {model}, Content: {content[:50]}...", cursor)
-            print(f"Message added successfully with ID: {message_id}")
+        with database_transaction() as cur:
+            message_id = _insert_message(cur, conversation_id, role, content, model)
+            logger.debug("Message added successfully with ID: %s", message_id)
             return message_id
             
     except Exception as e:
-        print(f"Error adding message: {e}")
+        logger.error("Error adding message: %s", e)
+        raise e
+
+
+def _insert_message(cursor, conversation_id: int, role: str, content: str, model: str) -> int:
+    """Inserts a message and its log entry using the caller's transaction."""
+    # The foreign key on conversation_id rejects unknown conversations
+    try:
+        cursor.execute(_SQL_INSERT_MESSAGE, (conversation_id, role, content, model))
+    except sqlite3.IntegrityError:
+        raise ValueError(f"Conversation with ID {conversation_id} does not exist")
+    
+    message_id = cursor.lastrowid
+    if message_id is None:
+        raise sqlite3.Error("Failed to add message - no ID returned")
+    
+    log_action("Message added", f"Conversation ID: {conversation_id}, Role: {role}, Model: {model}, Content: {content[:50]}...", cursor)
+    return message_id
+
+
+def add_messages(conversation_id: int, rows: list[tuple[str, str, str]], cursor=None) -> list[int]:
+    """Adds several (role, content, model) messages to a conversation with one executemany."""
+    # Input validation
+    if not isinstance(conversation_id, int) or conversation_id <= 0:
+        raise ValueError("conversation_id must be a positive integer")
+    params = []
+    for role, content, model in rows:
+        role = _stripped(role, "role")
+        if not isinstance(content, str):
+            raise ValueError("content must be a string")
+        model = _stripped(model, "model")
+        params.append((conversation_id, role, content, model))
+
+    if not params:
+        return []
+
+    if cursor is not None:
+        # Using provided cursor (within existing transaction)
+        return _insert_messages(cursor, conversation_id, params)
+
+    try:
+        with database_transaction() as cur:
+            message_ids = _insert_messages(cur, conversation_id, params)
+            logger.debug("%s messages added successfully", len(message_ids))
+            return message_ids
+
+    except Exception as e:
+        logger.error("Error adding messages: %s", e)
         raise e
 
 
+def _insert_messages(cursor, conversation_id: int, params: list[tuple]) -> list[int]:
+    """Bulk-inserts messages and one log entry using the caller's transaction."""
+    # The foreign key on conversation_id rejects unknown conversations
+    try:
+        cursor.executemany(_SQL_INSERT_MESSAGE, params)
+    except sqlite3.IntegrityError:
+        raise ValueError(f"Conversation with ID {conversation_id} does not exist")
+
+    # executemany leaves lastrowid unset. The write lock keeps other inserts out, so the
+    # AUTOINCREMENT IDs of this batch are the contiguous run ending at last_insert_rowid()
+    last_id = cursor.execute(_SQL_LAST_INSERT_ROWID).fetchone()[0]
+    message_ids = list(range(last_id - len(params) + 1, last_id + 1))
+
+    log_action("Messages added", f"Conversation ID: {conversation_id}, Count: {len(params)}", cursor)
+    return message_ids
+
+
 
-def log_action(action: str, details: str, cursor=None) -> int:
-    """Logs an action to the logs table."""
+def log_action(action: str, details: str, cursor=None) -> Optional[int]:
+    """Logs an action to the logs table.
+
+    With a cursor the row is queued and written together with the transaction's other
+    log rows when it commits; None is returned in that case.
+    """
     # Input validation
-    if not isinstance(action, str) or not action.strip():
-        raise ValueError("action must be a non-empty string")
+    action = _stripped(action, "action")
     if not isinstance(details, str):
         raise ValueError("details must be a string")
     
-    now = datetime.now().isoformat()
-    
     if cursor is not None:
-        # Using provided cursor (within existing transaction)
-        cursor.execute("INSERT INTO logs (timestamp, action, details) VALUES (?, ?, ?)", 
-                      (now, action.strip(), details))
-        
-        log_id = cursor.lastrowid
-        if log_id is None:
-            raise sqlite3.Error("Failed to log action - no ID returned")
-        return log_id
+        # Within an existing transaction: written when it commits
+        cursor.connection.pending_logs.append((action, details))
+        return None
     else:
         # Create new transaction
         try:
             with database_transaction() as cur:
-                cur.execute("INSERT INTO logs (timestamp, action, details) VALUES (?, ?, ?)", 
-                           (now, action.strip(), details))
+                cur.execute(_SQL_INSERT_LOG, (action, details))
                 
                 log_id = cur.lastrowid
                 if log_id is None:
                     raise sqlite3.Error("Failed to log action - no ID returned")
                 
-                print(f"Action logged successfully with ID: {log_id}")
+                logger.debug("Action logged successfully with ID: %s", log_id)
                 return log_id
                 
         except Exception as e:
-            print(f"Error logging action: {e}")
+            logger.error("Error logging action: %s", e)
             raise e
 
 
-def get_conversations_by_user(user_id: int):
-    """Returns a list of conversations (dict) for a given user, ordered by date descending."""
+def log_actions(entries: list[tuple[str, str]], cursor=None) -> int:
+    """Logs several (action, details) pairs with a single executemany; returns the number logged."""
     # Input validation
-    if not isinstance(user_id, int) or user_id <= 0:
-        raise ValueError("user_id must be a positive integer")
+    rows = []
+    for action, details in entries:
+        action = _stripped(action, "action")
+        if not isinstance(details, str):
+            raise ValueError("details must be a string")
+        rows.append((action, details))
+
+    if not rows:
+        return 0
+
+    if cursor is not None:
+        # Within an existing transaction: written when it commits
+        cursor.connection.pending_logs.extend(rows)
+        return len(rows)
+    else:
+        # Create new transaction
+        try:
+            with database_transaction() as cur:
+                cur.executemany(_SQL_INSERT_LOG, rows)
+                logger.debug("%s actions logged successfully", len(rows))
+                return len(rows)
+
+        except Exception as e:
+            logger.error("Error logging actions: %s", e)
+            raise e
+
+
+def get_messages_by_conversation(conversation_id: int):
+    """Returns a list of messages (sqlite3.Row) for a given conversation, in the order they were added. Timestamps are Unix seconds."""
+    # Input validation
+    if not isinstance(conversation_id, int) or conversation_id <= 0:
+        raise ValueError("conversation_id must be a positive integer")
     
     try:
-        with database_transaction(isolation_level="READ_UNCOMMITTED") as cursor:
-            cursor.execute("SELECT conversation_id, start_time FROM conversations WHERE user_id = ? ORDER BY start_time DESC", (user_id,))
-            rows = cursor.fetchall()
-            return [
-                {"conversation_id": row[0], "start_time": row[1]} for row in rows
-            ]
+        with database_transaction(isolation_level="READ_UNCOMMITTED", read_only=True) as cursor:
+            cursor.execute(_SQL_SELECT_MESSAGES, (conversation_id,))
+            return cursor.fetchall()
     except Exception as e:
-        print(f"Error getting conversations by user: {e}")
+        logger.error("Error getting messages by conversation: %s", e)
         raise e
 
-def get_messages_by_conversation(conversation_id: int):
-    """Returns a list of messages (dict) for a given conversation, ordered by timestamp ascending."""
+def get_messages_page(conversation_id: int, after_id: int = 0, limit: int = 100):
+    """
+    Returns up to `limit` messages (sqlite3.Row) of a conversation with message_id > after_id,
+    in the order they were added. Pass the last row's message_id as after_id to get the next page.
+    """
     # Input validation
     if not isinstance(conversation_id, int) or conversation_id <= 0:
         raise ValueError("conversation_id must be a positive integer")
-    
+    if not isinstance(after_id, int) or after_id < 0:
+        raise ValueError("after_id must be a non-negative integer")
+    if not isinstance(limit, int) or limit <= 0:
+        raise ValueError("limit must be a positive integer")
+
     try:
-        with database_transaction(isolation_level="READ_UNCOMMITTED") as cursor:
-            cursor.execute("SELECT role, content, model, timestamp FROM messages WHERE conversation_id = ? ORDER BY timestamp ASC", (conversation_id,))
-            rows = cursor.fetchall()
-            return [
-                {"role": row[0], "content": row[1], "model": row[2], "timestamp": row[3]} for row in rows
-            ]
+        with database_transaction(isolation_level="READ_UNCOMMITTED", read_only=True) as cursor:
+            cursor.execute(_SQL_SELECT_MESSAGES_PAGE, (conversation_id, after_id, limit))
+            return cursor.fetchall()
     except Exception as e:
-        print(f"Error getting messages by conversation: {e}")
+        logger.error("Error getting messages page: %s", e)
+        raise e
+
+def get_chat_titles(user_id: int):
+    """
+    Returns the user's conversations (sqlite3.Row) newest first, each with a title taken from
+    the first 30 characters of its first user message (None if it has no messages yet).
+    """
+    # Input validation
+    if not isinstance(user_id, int) or user_id <= 0:
+        raise ValueError("user_id must be a positive integer")
+
+    try:
+        with database_transaction(isolation_level="READ_UNCOMMITTED", read_only=True) as cursor:
+            cursor.execute(_SQL_SELECT_CHAT_TITLES, (user_id,))
+            return cursor.fetchall()
+    except Exception as e:
+        logger.error("Error getting chat titles: %s", e)
         raise e
 
 
@@ -482,31 +777,25 @@ def create_conversation_with_message(user_id: int, role: str, content: str, mode
     # Input validation
     if not isinstance(user_id, int) or user_id <= 0:
         raise ValueError("user_id must be a positive integer")
-    if not isinstance(role, str) or not role.strip():
-        raise ValueError("role must be a non-empty string")
+    role = _stripped(role, "role")
     if not isinstance(content, str):
         raise ValueError("content must be a string")
-    if not isinstance(model, str) or not model.strip():
-        raise ValueError("model must be a non-empty string")
+    model = _stripped(model, "model")
     
     try:
         with database_transaction() as cursor:
-            # Check if user exists with row-level locking
-            cursor.execute("SELECT user_id FROM users WHERE user_id = ? FOR UPDATE", (user_id,))
-            if not cursor.fetchone():
+            # Create conversation; the foreign key on user_id rejects unknown users
+            try:
+                cursor.execute(_SQL_INSERT_CONVERSATION, (user_id,))
+            except sqlite3.IntegrityError:
                 raise ValueError(f"User with ID {user_id} does not exist")
-            
-            # Create conversation
-            now = datetime.now().isoformat()
-            cursor.execute("INSERT INTO conversations (user_id, start_time) VALUES (?, ?)", (user_id, now))
             conversation_id = cursor.lastrowid
             
             if conversation_id is None:
                 raise sqlite3.Error("Failed to create conversation - no ID returned")
             
             # Add first message
-            cursor.execute("INSERT INTO messages (conversation_id, role, content, model, timestamp) VALUES (?, ?, ?, ?, ?)", 
-                          (conversation_id, role.strip(), content, model.strip(), now))
+            cursor.execute(_SQL_INSERT_MESSAGE, (conversation_id, role, content, model))
             
             message_id = cursor.lastrowid
             if message_id is None:
@@ -517,9 +806,9 @@ def create_conversation_with_message(user_id: int, role: str, content: str, mode
                       f"User ID: {user_id}, Conversation ID: {conversation_id}, Message ID: {message_id}", 
                       cursor)
             
-            print(f"Conversation with message created successfully - Conversation ID: {conversation_id}, Message ID: {message_id}")
+            logger.debug("Conversation with message created successfully - Conversation ID: %s, Message ID: %s", conversation_id, message_id)
             return conversation_id, message_id
             
     except Exception as e:
-        print(f"Error creating conversation with message: {e}")
+        logger.error("Error creating conversation with message: %s", e)
         raise e
\ No newline at end of file
@@ -20,19 +20,465 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from openai import OpenAI
+import asyncio
+import collections
+import contextlib
+import functools
+import hashlib
+import importlib.util
+import inspect
 import json
-import requests
+import logging
+import os
+import sqlite3
+import threading
+import time
+from types import MappingProxyType
+from typing import TYPE_CHECKING, NamedTuple
 
+if TYPE_CHECKING:
+    import numpy as np
+    from openai import AsyncOpenAI
 
+try:
+    import orjson  # C-implemented JSON, used for secrets.json and cache keys when available
+except ImportError:
+    orjson = None
+
+try:
+    from blake3 import blake3 as _hasher  # Faster than the stdlib hashes on short inputs
+except ImportError:
+    _hasher = functools.partial(hashlib.blake2b, digest_size=16)
+
+try:
+    import tiktoken  # Exact token counts for the context-window trimming below
+except ImportError:
+    tiktoken = None
+
+# Optional: needed by the semantic cache below. Only probed here, since importing it
+# pulls in torch; the import happens when the cache first embeds a prompt.
+_HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec("sentence_transformers") is not None
+
+logger = logging.getLogger(__name__)
+
+# Sent with every request; read-only so all requests can share the same objects
+_EXTRA_HEADERS = MappingProxyType({
+    "HTTP-Referer": "https://tuapp.streamlit.app",  # Optional
+    "X-Title": "My Streamlit App",  # Optional
+})
+_EXTRA_BODY = MappingProxyType({})
+
+# Requests in flight at once during a fan-out, to stay under OpenRouter's rate limits
+MAX_CONCURRENT_REQUESTS = 8
+# Retries on 429 / connection errors, done by the SDK with jittered exponential backoff
+MAX_RETRIES = 2
+
+
+class ModelSpec(NamedTuple):
+    """Everything the module needs to know about one model; see ModelsData.MODELS."""
+    id: str  # OpenRouter model ID
+    label: str  # Display name used in error messages
+    context_window: int  # Tokens of the free endpoint; prompts are trimmed to fit
+    # Async path limits: OpenRouter's free models allow 20 requests per minute, and
+    # max_concurrency caps how many requests to the model may be in flight
+    rpm: int = 20
+    max_concurrency: int = 4
+    accepts_images: bool = False  # Whether the user message may carry an image_url part
+
+
+class _ProviderThrottle:
+    """
+    Paces requests to one model: a sliding one-minute window enforces its rpm, and the
+    concurrency limit adapts AIMD-style, halving after a rate-limit error and growing by
+    one per success up to max_concurrency. State is plain Python guarded by a thread
+    lock, so one throttle serves every event loop (each fan-out runs its own).
+    """
+
+    def __init__(self, rpm: int, max_concurrency: int):
+        self.rpm = rpm
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.sent = collections.deque()  # Start times of the requests in the last minute
+        self._lock = threading.Lock()
+
+    def _try_acquire(self) -> float:
+        """Takes a slot and returns 0, or returns how long to wait before trying again."""
+        with self._lock:
+            now = time.monotonic()
+            while self.sent and now - self.sent[0] >= 60:
+                self.sent.popleft()
+            if len(self.sent) >= self.rpm:
+                return 60 - (now - self.sent[0])
+            if self.in_flight >= int(self.limit):
+                return 0.05
+            self.in_flight += 1
+            self.sent.append(now)
+            return 0
+
+    async def acquire(self):
+        """Waits until a request to this model is allowed."""
+        while (delay := self._try_acquire()) > 0:
+            await asyncio.sleep(delay)
+
+    def release(self, rate_limited: bool):
+        """Frees the slot and adjusts the concurrency limit from the outcome."""
+        with self._lock:
+            self.in_flight -= 1
+            if rate_limited:
+                self.limit = max(1.0, self.limit / 2)
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1)
+
+
+# OpenRouter model ID -> its throttle, created on the model's first async request
+_throttles: dict[str, _ProviderThrottle] = {}
+_throttles_lock = threading.Lock()
+
+
+def _get_throttle(spec: ModelSpec) -> _ProviderThrottle:
+    """Returns the shared throttle for a model, creating it from its spec on first use."""
+    with _throttles_lock:
+        throttle = _throttles.get(spec.id)
+        if throttle is None:
+            throttle = _throttles[spec.id] = _ProviderThrottle(spec.rpm, spec.max_concurrency)
+        return throttle
+
+
+# Part of the context window kept free for the reply. Prompts that don't fit are trimmed
+# before sending by _fit_to_context.
+RESERVED_OUTPUT_TOKENS = 4096
+_MESSAGE_OVERHEAD_TOKENS = 4  # Role and separators added per message
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoding():
+    """
+    Loads tiktoken's cl100k_base on first use, or returns None to fall back to the
+    estimate. Not done at import: on a cold cache tiktoken downloads the BPE file,
+    which fails (or stalls) offline.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logger.warning("tiktoken encoding unavailable, estimating token counts: %s", e)
+        return None
+
+
+def _count_tokens(text: str) -> int:
+    """Counts tokens with tiktoken's cl100k_base, or estimates ~4 characters per token."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return (len(text) + 3) // 4
+
+
+def _truncate_to_tokens(text: str, max_tokens: int, keep_start: bool = False) -> str:
+    """
+    Keeps the last max_tokens tokens of text, where a question usually ends, or the
+    first ones with keep_start (for system prompts, which usually lead with the role).
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding()
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        return encoding.decode(tokens[:max_tokens] if keep_start else tokens[-max_tokens:])
+    return text[:max_tokens * 4] if keep_start else text[-max_tokens * 4:]
+
+
+def _message_tokens(message: dict) -> int:
+    """Tokens of a message's text; image parts aren't counted."""
+    content = message["content"]
+    if isinstance(content, str):
+        return _MESSAGE_OVERHEAD_TOKENS + _count_tokens(content)
+    return _MESSAGE_OVERHEAD_TOKENS + sum(_count_tokens(p["text"]) for p in content if p.get("type") == "text")
+
+
+def _fit_to_context(context_window: int, messages: list) -> list:
+    """
+    Returns messages trimmed to context_window minus RESERVED_OUTPUT_TOKENS:
+    the oldest non-system messages are dropped first (the last one is always kept),
+    then the last message's text is cut down to what remains. The last message keeps at
+    least half the budget (all of it if shorter); if the system prompts leave less than
+    that, they are cut down too, keeping their start.
+    """
+    budget = context_window - RESERVED_OUTPUT_TOKENS
+    counts = [_message_tokens(m) for m in messages]
+    total = sum(counts)
+    if total <= budget:
+        return messages
+    keep = [True] * len(messages)
+    for i, message in enumerate(messages[:-1]):
+        if total <= budget:
+            break
+        if message["role"] != "system":
+            keep[i] = False
+            total -= counts[i]
+    trimmed = [m for m, k in zip(messages, keep) if k]
+    if total > budget:
+        question = counts[-1] - _MESSAGE_OVERHEAD_TOKENS
+        allowed = max(question - (total - budget), min(question, budget // 2))
+        # Every earlier message left is a system prompt; they give up what the question can't
+        excess = total - budget - (question - allowed)
+        for i in range(len(trimmed) - 2, -1, -1):
+            if excess <= 0:
+                break
+            text = trimmed[i]["content"]
+            tokens = _count_tokens(text)
+            shortened = _truncate_to_tokens(text, tokens - excess, keep_start=True)
+            trimmed[i] = {**trimmed[i], "content": shortened}
+            excess -= tokens - _count_tokens(shortened)
+        last = dict(trimmed[-1])
+        if isinstance(last["content"], str):
+            last["content"] = _truncate_to_tokens(last["content"], allowed)
+        else:
+            last["content"] = [
+                {**p, "text": _truncate_to_tokens(p["text"], allowed)} if p.get("type") == "text" else p
+                for p in last["content"]
+            ]
+        trimmed[-1] = last
+    return trimmed
+
+# Exact-match response cache: key -> (stored at, response). Module-level so it is shared
+# by every ModelsData, since the Streamlit script builds a new one on each rerun.
+CACHE_TTL = 1800  # seconds
+CACHE_MAX_ENTRIES = 256
+_response_cache: dict[str, tuple[float, str]] = {}
+_cache_lock = threading.Lock()
+
+
+def _cache_key(model: str, messages: list) -> str:
+    """Hashes the model and the full messages list into a cache key."""
+    request = {"model": model, "messages": messages}
+    if orjson is not None:
+        payload = orjson.dumps(request, option=orjson.OPT_SORT_KEYS)
+    else:
+        payload = json.dumps(request, sort_keys=True).encode("utf-8")
+    # Keys never leave this process and its cache file, so a fast non-SHA-2 hash is enough
+    return _hasher(payload).hexdigest()
+
+
+def _cache_get(key: str):
+    """Returns the cached response for key, or None if missing or expired."""
+    with _cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+        stored_at, response = entry
+        if time.monotonic() - stored_at > CACHE_TTL:
+            del _response_cache[key]
+            return None
+        return response
+
+
+def _cache_put(key: str, response: str):
+    """Stores a response, evicting the oldest entry once the cache is full."""
+    if not response:
+        return
+    with _cache_lock:
+        _response_cache.pop(key, None)
+        if len(_response_cache) >= CACHE_MAX_ENTRIES:
+            del _response_cache[next(iter(_response_cache))]
+        _response_cache[key] = (time.monotonic(), response)
+
+
+# Semantic cache: on an exact-match miss, a reply to a paraphrase of the same prompt (same
+# model and system prompt, no image) is reused when the embeddings' cosine similarity
+# reaches SEMANTIC_CACHE_THRESHOLD. Off by default, since a paraphrase can still call for
+# a different answer; set SEMANTIC_CACHE_ENABLED = True to opt in (needs
+# sentence-transformers). Read on each request, so it can be changed at any time.
+SEMANTIC_CACHE_ENABLED = False
+SEMANTIC_CACHE_MODEL = "all-MiniLM-L6-v2"
+SEMANTIC_CACHE_THRESHOLD = 0.90
+# context key -> [(stored at, normalized embedding, response)]
+_semantic_cache: dict[str, list[tuple[float, "np.ndarray", str]]] = {}
+
+
+@functools.lru_cache(maxsize=1)
+def _embedder():
+    """Loads the embedding model on first use."""
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(SEMANTIC_CACHE_MODEL)
+
+
+def _semantic_context(model: str, messages: list):
+    """
+    Splits a request into (context key, user text) for the semantic cache, or returns
+    None when it doesn't apply (semantic cache disabled or unavailable, or the prompt has
+    an image).
+    """
+    if not (SEMANTIC_CACHE_ENABLED and _HAS_SENTENCE_TRANSFORMERS) or not messages:
+        return None
+    prompt = messages[-1]
+    if prompt.get("role") != "user" or not isinstance(prompt.get("content"), str):
+        return None
+    return _cache_key(model, messages[:-1]), prompt["content"]
+
+
+def _semantic_get(context: str, embedding):
+    """Returns the most similar cached response in this context, if similar enough."""
+    import numpy as np  # Installed with sentence-transformers
+    now = time.monotonic()
+    with _cache_lock:
+        entries = [e for e in _semantic_cache.get(context, ()) if now - e[0] <= CACHE_TTL]
+    if not entries:
+        return None
+    # Embeddings are normalized, so the dot product is the cosine similarity
+    similarities = np.stack([e[1] for e in entries]) @ embedding
+    best = int(similarities.argmax())
+    return entries[best][2] if similarities[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+
+def _semantic_put(context: str, embedding, response: str):
+    """Stores a response under its prompt embedding, keeping at most CACHE_MAX_ENTRIES per context."""
+    if not response:
+        return
+    now = time.monotonic()
+    with _cache_lock:
+        entries = [e for e in _semantic_cache.get(context, ()) if now - e[0] <= CACHE_TTL]
+        entries.append((now, embedding, response))
+        _semantic_cache[context] = entries[-CACHE_MAX_ENTRIES:]
+
+
+# Second tier of the exact-match cache, persisted so replies survive Streamlit restarts.
+# It keeps every reply in plain text, keyed by a hash of its prompt. DISK_CACHE_PATH is
+# read on each lookup, so it can be pointed elsewhere, or set to None to disable the
+# cache, at any time.
+DISK_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "customchatfree", "llm.sqlite")
+
+
+class _DiskCache:
+    """Exact-match response cache stored in a SQLite file, keyed like the in-memory one."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0  # time.monotonic() of the last _prune
+
+    def _prune(self, conn: sqlite3.Connection):
+        """Deletes the expired entries."""
+        conn.execute("DELETE FROM llm_cache WHERE ts < ?", (time.time() - CACHE_TTL,))
+        self._pruned_at = time.monotonic()
+
+    def _connect(self) -> sqlite3.Connection:
+        """Opens the file on first use and drops the entries that expired meanwhile."""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, ts REAL NOT NULL, model TEXT NOT NULL, response TEXT NOT NULL)"
+            )
+            self._prune(conn)
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str):
+        """Returns the cached response for key, or None if missing, expired or unreadable."""
+        try:
+            with self._lock:
+                row = self._connect().execute(
+                    "SELECT response FROM llm_cache WHERE key = ? AND ts >= ?",
+                    (key, time.time() - CACHE_TTL)
+                ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Response disk cache read failed: %s", e)
+            return None
+        return row[0] if row else None
+
+    def put(self, key: str, model: str, response: str):
+        """Stores a response; failures only cost the cache entry."""
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO llm_cache (key, ts, model, response) VALUES (?, ?, ?, ?)",
+                    (key, time.time(), model, response)
+                )
+                # Pruned again once per CACHE_TTL, so a long-running server's file stays
+                # bounded by what it stores in about two TTLs
+                if time.monotonic() - self._pruned_at >= CACHE_TTL:
+                    self._prune(conn)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning("Response disk cache write failed: %s", e)
+
+
+_disk_cache = None
+_disk_cache_lock = threading.Lock()
+
+
+def _get_disk_cache():
+    """Returns the disk cache for the current DISK_CACHE_PATH, or None when it is disabled."""
+    global _disk_cache
+    path = DISK_CACHE_PATH
+    if not path:
+        return None
+    with _disk_cache_lock:
+        if _disk_cache is None or _disk_cache.path != path:
+            _disk_cache = _DiskCache(path)
+        return _disk_cache
+
+
+def _cache_lookup(model: str, messages: list):
+    """
+    Checks the in-memory and on-disk exact-match caches, then the semantic cache.
+    Returns (response, None) on a hit, or (None, entry) on a miss, where entry is passed
+    to _cache_store once the response is known.
+    """
+    key = _cache_key(model, messages)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached, None
+    disk_cache = _get_disk_cache()
+    if disk_cache is not None:
+        cached = disk_cache.get(key)
+        if cached is not None:
+            _cache_put(key, cached)
+            return cached, None
+    context = embedding = None
+    semantic = _semantic_context(model, messages)
+    if semantic is not None:
+        context, text = semantic
+        embedding = _embedder().encode(text, normalize_embeddings=True)
+        cached = _semantic_get(context, embedding)
+        if cached is not None:
+            return cached, None
+    return None, (key, model, context, embedding)
+
+
+def _cache_store(entry: tuple, response: str):
+    """Stores a response in the caches _cache_lookup missed."""
+    if not response:
+        return
+    key, model, context, embedding = entry
+    _cache_put(key, response)
+    disk_cache = _get_disk_cache()
+    if disk_cache is not None:
+        disk_cache.put(key, model, response)
+    if context is not None:
+        _semantic_put(context, embedding, response)
+
+
+@functools.lru_cache(maxsize=1)
 def _load_api_key() -> str:
     """
     Loads the API key from a local secrets.json file.
     Assumes the file is in the project root directory.
+    The parsed file is cached, so it is only read once per process.
     """
     try:
-        with open("secrets.json", "r") as f:
-            secrets = json.load(f)
+        if orjson is not None:
+            with open("secrets.json", "rb") as f:
+                secrets = orjson.loads(f.read())
+        else:
+            with open("secrets.json", "r") as f:
+                secrets = json.load(f)
         return secrets
     except FileNotFoundError:
         raise FileNotFoundError("The 'secrets.json' file was not found. Make sure it exists in the root directory.")
@@ -40,82 +486,125 @@ def _load_api_key() -> str:
         raise KeyError("The 'openroute_api_key' key was not found in secrets.json.")
 
 
-def get_client():
-    return OpenAI(
+# API key -> shared OpenAI client. Built under a lock: the warm-up thread and the first
+# ModelsData can ask for the same client at once, and both must get the same instance.
+_clients = {}
+_client_lock = threading.Lock()
+
+
+def get_client(api_key: str = None):
+    """
+    Returns the shared client for this API key. Reusing one instance keeps its HTTP
+    connection pool (and the TLS sessions to OpenRouter) alive across Streamlit reruns.
+    """
+    api_key = api_key or _load_api_key()['openroute_api_key']  # Load the key from the JSON file
+    with _client_lock:
+        client = _clients.get(api_key)
+        if client is None:
+            from openai import OpenAI  # Imported on first use to keep the module cheap to import
+            client = _clients[api_key] = OpenAI(
+                base_url="https://openrouter.ai/api/v1",
+                api_key=api_key,
+                max_retries=MAX_RETRIES,
+            )
+        return client
+
+
+def get_async_client(api_key: str = None):
+    """
+    Async client for concurrent requests. Create it inside the running event loop
+    (its connection pool is bound to that loop) and close it when done.
+    """
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(
         base_url="https://openrouter.ai/api/v1",
-        api_key=_load_api_key()['openroute_api_key'],  # Load the key from the JSON file
+        api_key=api_key or _load_api_key()['openroute_api_key'],
+        max_retries=MAX_RETRIES,
     )
 
 
+def _request_errors() -> tuple:
+    """
+    The errors a model request can raise: OpenAI API errors and httpx transport errors.
+    Resolved when an error is caught, so importing this module doesn't import the SDK.
+    """
+    import httpx
+    from openai import APIError
+    return APIError, httpx.HTTPError
+
+
+def _safe(method):
+    """
+    Decorates a ModelsData request method whose first argument is the model name, so a
+    failed request is logged and answered with "[Error contacting <model>: ...]" text.
+    Other exceptions are bugs and still propagate. Works on plain, async and generator
+    methods (a generator yields the error text as its last chunk).
+    """
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def wrapper(self, model_name, *args, **kwargs):
+            try:
+                yield from method(self, model_name, *args, **kwargs)
+            except _request_errors() as e:
+                yield self._error_text(model_name, e)
+    elif inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, model_name, *args, **kwargs):
+            try:
+                return await method(self, model_name, *args, **kwargs)
+            except _request_errors() as e:
+                return self._error_text(model_name, e)
+    else:
+        @functools.wraps(method)
+        def wrapper(self, model_name, *args, **kwargs):
+            try:
+                return method(self, model_name, *args, **kwargs)
+            except _request_errors() as e:
+                return self._error_text(model_name, e)
+    return wrapper
+
+
 class ModelsData:
     """
     Class to manage responses from OpenRouter models compatible with OpenAI.
     Uses the Factory Method pattern to select the model.
     """
+    # Model key -> its ModelSpec (OpenRouter ID, display name, context window, limits)
+    MODELS = {
+        "deepseek_v3": ModelSpec("deepseek/deepseek-chat-v3-0324:free", "DeepSeek Chat v3", 163840),
+        "kimi": ModelSpec("moonshotai/kimi-k2:free", "Kimi", 32768),
+        "gemini_flash": ModelSpec("google/gemini-2.0-flash-exp:free", "Gemini 2.0 Flash", 1048576,
+                                  accepts_images=True),
+        "qwq_32b": ModelSpec("qwen/qwq-32b:free", "Qwen QWQ-32B", 32768),
+        "mistral_nemo": ModelSpec("mistralai/mistral-nemo:free", "Mistral Nemo", 131072),
+    }
+
     def __init__(self):
         secrets = _load_api_key()
         self.api_key = secrets['openroute_api_key']
-        self.client = get_client()
-        self.extra_headers = {
-            "HTTP-Referer": "https://tuapp.streamlit.app",  # Optional
-            "X-Title": "My Streamlit App",  # Optional
-        }
-        self.extra_body = {}
+        self.client = get_client(self.api_key)
 
     def get_response(self, message: str, model_name: str, system_message: str = None) -> str:
         """
         Factory Method to get the response from a model given its name.
         Allows including a system message (system prompt) if provided.
         """
-        model_methods = {
-            "deepseek_v3": self.deepseek_v3,
-            "kimi": self.kimi,
-            "gemini_flash": self.gemini_flash,
-            "qwq_32b": self.qwq_32b,
-            "mistral_nemo": self.mistral_nemo,
-        }
-        method = model_methods.get(model_name)
-        if not method:
+        # Each MODELS key is also the name of the method for that model
+        if model_name not in self.MODELS:
             return f"[Model '{model_name}' not supported]"
-        return method(message, system_message=system_message) if model_name == "gemini_flash" else method(message, system_message) if system_message else method(message)
+        return getattr(self, model_name)(message, system_message=system_message)
 
     def deepseek_v3(self, message: str, system_message: str = None) -> str:
         """
         Sends a message to DeepSeek Chat v3 (deepseek/deepseek-chat-v3-0324:free).
         """
-        try:
-            messages = []
-            if system_message:
-                messages.append({"role": "system", "content": system_message})
-            messages.append({"role": "user", "content": message})
-            completion = self.client.chat.completions.create(
-                extra_headers=self.extra_headers,
-                extra_body=self.extra_body,
-                model="deepseek/deepseek-chat-v3-0324:free",
-                messages=messages
-            )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"[Error contacting DeepSeek Chat v3: {e}]"
+        return self._chat("deepseek_v3", self._build_messages(message, system_message))
 
     def kimi(self, message: str, system_message: str = None) -> str:
         """
         Sends a message to Kimi (moonshotai/kimi-k2:free).
         """
-        try:
-            messages = []
-            if system_message:
-                messages.append({"role": "system", "content": system_message})
-            messages.append({"role": "user", "content": message})
-            completion = self.client.chat.completions.create(
-                extra_headers=self.extra_headers,
-                extra_body=self.extra_body,
-                model="moonshotai/kimi-k2:free",
-                messages=messages
-            )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"[Error contacting Kimi: {e}]"
+        return self._chat("kimi", self._build_messages(message, system_message))
 
     def gemini_flash(self, message: str, image_url: str = None, system_message: str = None) -> str:
         """
@@ -123,70 +612,209 @@ class ModelsData:
         If image_url is provided, sends text and image; if not, only text.
         If system_message is provided, sends it as a system message.
         """
-        try:
-            content = []
-            if system_message:
-                content.append({"type": "text", "text": system_message})
-            content.append({"type": "text", "text": message})
-            if image_url:
-                content.append({"type": "image_url", "image_url": {"url": image_url}})
-            messages = [
-                {
-                    "role": "user" if not system_message else "system",
-                    "content": content if not system_message else [{"type": "text", "text": system_message}],
-                }
-            ]
-            if system_message:
-                # system + user (+ image)
-                messages = [
-                    {"role": "system", "content": [{"type": "text", "text": system_message}]},
-                    {"role": "user", "content": [{"type": "text", "text": message}] + ([{"type": "image_url", "image_url": {"url": image_url}}] if image_url else [])}
-                ]
-            completion = self.client.chat.completions.create(
-                extra_headers=self.extra_headers,
-                extra_body=self.extra_body,
-                model="google/gemini-2.0-flash-exp:free",
-                messages=messages
-            )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"[Error contacting Gemini 2.0 Flash: {e}]"
+        return self._chat("gemini_flash", self._build_messages(message, system_message, image_url))
 
     def qwq_32b(self, message: str, system_message: str = None) -> str:
         """
         Sends a message to Qwen QWQ-32B (qwen/qwq-32b:free).
         """
-        try:
-            messages = []
-            if system_message:
-                messages.append({"role": "system", "content": system_message})
-            messages.append({"role": "user", "content": message})
-            completion = self.client.chat.completions.create(
-                extra_headers=self.extra_headers,
-                extra_body=self.extra_body,
-                model="qwen/qwq-32b:free",
-                messages=messages
-            )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"[Error contacting Qwen QWQ-32B: {e}]"
+        return self._chat("qwq_32b", self._build_messages(message, system_message))
 
     def mistral_nemo(self, message: str, system_message: str = None) -> str:
         """
         Sends a message to Mistral Nemo (mistralai/mistral-nemo:free).
         """
-        try:
-            messages = []
-            if system_message:
-                messages.append({"role": "system", "content": system_message})
+        return self._chat("mistral_nemo", self._build_messages(message, system_message))
+
+    def _chat(self, model_name: str, messages: list) -> str:
+        """
+        Sends the messages to the given model and returns the reply text. Replies are
+        cached for CACHE_TTL seconds, so an identical (or, with the semantic cache, a
+        paraphrased) request skips the network.
+        """
+        spec = self.MODELS[model_name]
+        messages = _fit_to_context(spec.context_window, messages)
+        cached, entry = _cache_lookup(spec.id, messages)
+        if cached is not None:
+            return cached
+        return self._complete(model_name, messages, entry)
+
+    @_safe
+    def _complete(self, model_name: str, messages: list, entry: tuple) -> str:
+        """Sends a request that missed the cache and stores the reply."""
+        completion = self.client.chat.completions.create(
+            extra_headers=_EXTRA_HEADERS,
+            extra_body=_EXTRA_BODY,
+            model=self.MODELS[model_name].id,
+            messages=messages
+        )
+        response = completion.choices[0].message.content
+        _cache_store(entry, response)
+        return response
+
+    def _accepts_images(self, model_name: str) -> bool:
+        """Whether the model takes an image_url part; False for unknown models."""
+        spec = self.MODELS.get(model_name)
+        return spec is not None and spec.accepts_images
+
+    def _error_text(self, model_name: str, e: Exception) -> str:
+        """Logs a failed request and returns the text shown in place of the reply."""
+        label = self.MODELS[model_name].label
+        logger.error("Error contacting %s: %s", label, e)
+        return f"[Error contacting {label}: {e}]"
+
+    @staticmethod
+    def _build_messages(message: str, system_message: str = None, image_url: str = None) -> list:
+        """
+        Builds the chat messages list: optional system prompt, then the user message
+        (with the image attached when image_url is provided).
+        """
+        messages = []
+        if system_message:
+            messages.append({"role": "system", "content": system_message})
+        if image_url:
+            messages.append({
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": message},
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                ],
+            })
+        else:
             messages.append({"role": "user", "content": message})
-            completion = self.client.chat.completions.create(
-                extra_headers=self.extra_headers,
-                extra_body=self.extra_body,
-                model="mistralai/mistral-nemo:free",
-                messages=messages
+        return messages
+
+    def stream_response(self, message: str, model_name: str, system_message: str = None, image_url: str = None):
+        """
+        Generator version of get_response: yields the text chunks as OpenRouter
+        streams them, so the UI can render tokens before the completion finishes.
+        A cached reply is yielded whole; a completed stream is added to the cache.
+        """
+        if model_name not in self.MODELS:
+            yield f"[Model '{model_name}' not supported]"
+            return
+        spec = self.MODELS[model_name]
+        messages = _fit_to_context(spec.context_window, self._build_messages(message, system_message, image_url))
+        cached, entry = _cache_lookup(spec.id, messages)
+        if cached is not None:
+            yield cached
+            return
+        yield from self._stream(model_name, messages, entry)
+
+    @_safe
+    def _stream(self, model_name: str, messages: list, entry: tuple):
+        """Streams a request that missed the cache; the reply is stored once complete."""
+        stream = self.client.chat.completions.create(
+            extra_headers=_EXTRA_HEADERS,
+            extra_body=_EXTRA_BODY,
+            model=self.MODELS[model_name].id,
+            messages=messages,
+            stream=True
+        )
+        chunks = []
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                chunks.append(chunk.choices[0].delta.content)
+                yield chunks[-1]
+        _cache_store(entry, "".join(chunks))
+
+    async def aget_response(self, message: str, model_name: str, system_message: str = None,
+                            image_url: str = None, client: "AsyncOpenAI" = None,
+                            semaphore: asyncio.Semaphore = None) -> str:
+        """
+        Async counterpart of get_response, sharing its response cache. Pass a shared
+        client when fanning out several requests; otherwise a client is opened just for
+        this call. Cache misses wait for the semaphore, if given, to bound how many
+        requests run at once; hits return without entering it.
+        """
+        if model_name not in self.MODELS:
+            return f"[Model '{model_name}' not supported]"
+        spec = self.MODELS[model_name]
+        messages = _fit_to_context(spec.context_window, self._build_messages(message, system_message, image_url))
+        # In a worker thread: the disk cache read and the prompt embedding would block the loop
+        cached, entry = await asyncio.to_thread(_cache_lookup, spec.id, messages)
+        if cached is not None:
+            return cached
+        if client is None:
+            async with get_async_client(self.api_key) as own_client:
+                return await self._achat(model_name, messages, entry, own_client, semaphore)
+        return await self._achat(model_name, messages, entry, client, semaphore)
+
+    @_safe
+    async def _achat(self, model_name: str, messages: list, entry: tuple, client: "AsyncOpenAI",
+                     semaphore: asyncio.Semaphore = None) -> str:
+        """Async counterpart of _complete for a request that already missed the cache."""
+        from openai import RateLimitError
+        throttle = _get_throttle(self.MODELS[model_name])
+        await throttle.acquire()
+        rate_limited = False
+        try:
+            async with semaphore or contextlib.nullcontext():
+                completion = await client.chat.completions.create(
+                    extra_headers=_EXTRA_HEADERS,
+                    extra_body=_EXTRA_BODY,
+                    model=self.MODELS[model_name].id,
+                    messages=messages
+                )
+        except RateLimitError:
+            rate_limited = True
+            raise
+        finally:
+            throttle.release(rate_limited)
+        response = completion.choices[0].message.content
+        # Like the lookup in aget_response, the disk write stays off the event loop
+        await asyncio.to_thread(_cache_store, entry, response)
+        return response
+
+    async def ask_many(self, message: str, model_names: list, system_message: str = None,
+                       image_url: str = None) -> dict:
+        """
+        Sends the same message to several models concurrently with asyncio.gather,
+        so the total wait is roughly the slowest model rather than the sum of all.
+        Cached replies are answered locally; the rest share one client and semaphore.
+        The image, if any, is only attached for the models that accept one.
+        Returns a dict mapping each model name to its response; a model whose request
+        failed gets the "[Error contacting <model>: ...]" text, like _safe gives.
+        """
+        # Created here rather than in __init__: asyncio primitives belong to the running loop
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        async with get_async_client(self.api_key) as client:
+            # return_exceptions: an error _safe doesn't catch (such as a malformed reply)
+            # must not discard the replies of the other models
+            responses = await asyncio.gather(
+                *(self.aget_response(message, name, system_message,
+                                     image_url if self._accepts_images(name) else None, client, semaphore)
+                  for name in model_names),
+                return_exceptions=True
             )
-            return completion.choices[0].message.content
-        except Exception as e:
-            return f"[Error contacting Mistral Nemo: {e}]"
+        results = {}
+        for name, response in zip(model_names, responses):
+            if isinstance(response, Exception):
+                response = self._error_text(name, response)
+            elif isinstance(response, BaseException):
+                raise response  # Cancellation and the like still end the fan-out
+            results[name] = response
+        return results
+
+    def get_responses(self, message: str, model_names: list, system_message: str = None,
+                      image_url: str = None) -> dict:
+        """
+        Synchronous wrapper around ask_many for callers without an event loop
+        (such as the Streamlit script).
+        """
+        return asyncio.run(self.ask_many(message, model_names, system_message, image_url))
+
+
+def _warm_up():
+    """Opens the shared client's connection to OpenRouter ahead of the first request."""
+    try:
+        get_client().models.list()
+    except Exception as e:
+        logger.debug("Client warm-up skipped: %s", e)
+
 
+# DNS, TCP and TLS setup happen in the background while Streamlit finishes loading the
+# script, and the first chat request reuses the pooled connection. Set
+# CUSTOMCHATFREE_NO_WARMUP=1 to skip it (e.g. in tests or offline).
+if not os.environ.get("CUSTOMCHATFREE_NO_WARMUP"):
+    threading.Thread(target=_warm_up, name="openrouter-warm-up", daemon=True).start()
@@ -0,0 +1,219 @@
+import logging
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timezone
+
+from services import database as db_service
+
+
+class _TempDatabaseTest(unittest.TestCase):
+    """Points the module's connection pool at a fresh database file for each test."""
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self._saved = (db_service.DATABASE_FILE, db_service._write_conn, db_service._read_pool,
+                       db_service._read_pool_filled)
+        db_service.DATABASE_FILE = os.path.join(self._tmp.name, "chat_history.db")
+        db_service._write_conn = None
+        db_service._read_pool = queue.Queue()
+        db_service._read_pool_filled = False
+
+    def tearDown(self):
+        if db_service._write_conn is not None:
+            db_service._write_conn.close()
+        while not db_service._read_pool.empty():
+            db_service._read_pool.get_nowait().close()
+        (db_service.DATABASE_FILE, db_service._write_conn, db_service._read_pool,
+         db_service._read_pool_filled) = self._saved
+        self._tmp.cleanup()
+
+
+class ConcurrentReadWriteTest(_TempDatabaseTest):
+    """Readers and writers sharing the connection pool from several threads."""
+
+    def setUp(self):
+        super().setUp()
+        db_service.initialize_database()
+
+    def test_readers_do_not_flush_writer_logs(self):
+        user_id = db_service.get_user_id("alice")
+        conversation_id = db_service.create_conversation(user_id)
+        writes_per_thread = 25
+        errors = []
+
+        def writer():
+            try:
+                for i in range(writes_per_thread):
+                    db_service.add_message(conversation_id, "user", f"message {i}", "model")
+            except Exception as e:
+                errors.append(e)
+
+        def reader():
+            try:
+                for _ in range(writes_per_thread * 2):
+                    db_service.get_messages_by_conversation(conversation_id)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer) for _ in range(3)]
+        threads += [threading.Thread(target=reader) for _ in range(db_service.READ_POOL_SIZE)]
+        with self.assertNoLogs("services.database", logging.ERROR):
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(errors, [])
+        messages = db_service.get_messages_by_conversation(conversation_id)
+        self.assertEqual(len(messages), 3 * writes_per_thread)
+
+        # Every message wrote exactly one log row, inside its own transaction
+        conn = sqlite3.connect(db_service.DATABASE_FILE)
+        try:
+            (logged,) = conn.execute("SELECT COUNT(*) FROM logs WHERE action = 'Message added'").fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(logged, 3 * writes_per_thread)
+
+    def test_read_during_write_with_queued_logs(self):
+        user_id = db_service.get_user_id("bob")
+        conversation_id = db_service.create_conversation(user_id)
+        queued = threading.Event()
+        read_done = threading.Event()
+        results = {}
+
+        def writer():
+            with db_service.database_transaction() as cursor:
+                db_service.add_message(conversation_id, "user", "hello", "model", cursor=cursor)
+                queued.set()
+                # Keep the transaction, and its queued log row, open while the reader runs
+                read_done.wait(5)
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            self.assertTrue(queued.wait(5))
+            # The reader must neither see nor try to write the writer's queued log row
+            with self.assertNoLogs("services.database", logging.ERROR):
+                results["read"] = db_service.get_messages_by_conversation(conversation_id)
+        finally:
+            read_done.set()
+            thread.join()
+
+        self.assertEqual(results["read"], [])
+        self.assertEqual(len(db_service.get_messages_by_conversation(conversation_id)), 1)
+
+
+class MessagesPageTest(_TempDatabaseTest):
+    def setUp(self):
+        super().setUp()
+        db_service.initialize_database()
+
+    def test_pages_do_not_hold_read_connections(self):
+        conversation_id = db_service.create_conversation(db_service.get_user_id("carol"))
+        db_service.add_messages(conversation_id, [("user", f"message {i}", "model") for i in range(5)])
+
+        # More pages than pooled read connections, all kept at once
+        pages = [db_service.get_messages_page(conversation_id, after_id=i, limit=2)
+                 for i in range(db_service.READ_POOL_SIZE + 1)]
+        self.assertEqual([[row["message_id"] for row in page] for page in pages[:2]], [[1, 2], [2, 3]])
+        self.assertEqual(db_service._read_pool.qsize(), db_service.READ_POOL_SIZE)
+
+    def test_invalid_arguments_raise_immediately(self):
+        with self.assertRaises(ValueError):
+            db_service.get_messages_page(1, limit=0)
+
+
+# The schema of the first release (user_version 0), whose timestamps were
+# datetime.now().isoformat() text in local time
+_V0_SCHEMA = """
+CREATE TABLE users (user_id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT UNIQUE NOT NULL);
+CREATE TABLE roles (role_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, name TEXT NOT NULL,
+                    description TEXT, FOREIGN KEY (user_id) REFERENCES users (user_id) ON DELETE CASCADE);
+CREATE TABLE conversations (conversation_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                            start_time DATETIME NOT NULL, role_id INTEGER);
+CREATE TABLE messages (message_id INTEGER PRIMARY KEY AUTOINCREMENT, conversation_id INTEGER NOT NULL,
+                       role TEXT NOT NULL, content TEXT NOT NULL, model TEXT NOT NULL, timestamp DATETIME NOT NULL);
+CREATE TABLE logs (log_id INTEGER PRIMARY KEY AUTOINCREMENT, timestamp DATETIME NOT NULL, action TEXT NOT NULL,
+                   details TEXT);
+CREATE INDEX idx_conversations_user_id ON conversations(user_id);
+CREATE INDEX idx_messages_timestamp ON messages(timestamp);
+"""
+
+
+@unittest.skipUnless(hasattr(time, "tzset"), "needs time.tzset to run in a fixed time zone")
+class SchemaUpgradeTest(_TempDatabaseTest):
+    """Upgrades a file written by the first release to the current schema."""
+
+    def setUp(self):
+        super().setUp()
+        # Ahead of UTC, so a local time read as UTC would show up, and so would local
+        # times sorting after the UTC ones written later
+        saved_tz = os.environ.get("TZ")
+        os.environ["TZ"] = "JST-9"
+        time.tzset()
+
+        def restore_tz():
+            if saved_tz is None:
+                os.environ.pop("TZ", None)
+            else:
+                os.environ["TZ"] = saved_tz
+            time.tzset()
+        self.addCleanup(restore_tz)
+
+    def _create_v0_database(self, local: str):
+        """Writes a v0 file holding one user, conversation, message and log row stamped `local`."""
+        conn = sqlite3.connect(db_service.DATABASE_FILE)
+        try:
+            conn.executescript(_V0_SCHEMA)
+            conn.execute("INSERT INTO users (username) VALUES ('alice')")
+            conn.execute("INSERT INTO conversations (user_id, start_time) VALUES (1, ?)", (local,))
+            conn.execute("INSERT INTO messages (conversation_id, role, content, model, timestamp) "
+                         "VALUES (1, 'user', 'hi', 'model', ?)", (local,))
+            conn.execute("INSERT INTO logs (timestamp, action, details) VALUES (?, 'Message added', '')", (local,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def test_legacy_timestamps_become_unix_seconds(self):
+        local = "2025-03-01T09:30:15.123456"
+        self._create_v0_database(local)
+
+        db_service.initialize_database()
+
+        expected = int(datetime.fromisoformat(local).timestamp())
+        (message,) = db_service.get_messages_by_conversation(1)
+        self.assertEqual(message["timestamp"], expected)
+        conn = sqlite3.connect(db_service.DATABASE_FILE)
+        try:
+            (log_time,) = conn.execute("SELECT timestamp FROM logs").fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(log_time, expected)
+
+    def test_legacy_conversations_sort_before_newer_ones(self):
+        # Started a minute ago, in local time
+        local = datetime.fromtimestamp(time.time() - 60).isoformat()
+        self._create_v0_database(local)
+
+        db_service.initialize_database()
+        newer = db_service.create_conversation(1)
+
+        titles = db_service.get_chat_titles(1)
+        self.assertEqual([row["conversation_id"] for row in titles], [newer, 1])
+        conn = sqlite3.connect(db_service.DATABASE_FILE)
+        try:
+            (start_time,) = conn.execute("SELECT start_time FROM conversations WHERE conversation_id = 1").fetchone()
+        finally:
+            conn.close()
+        expected = datetime.fromtimestamp(int(datetime.fromisoformat(local).timestamp()), timezone.utc)
+        self.assertEqual(start_time, expected.strftime("%Y-%m-%d %H:%M:%S"))
+
+
+if __name__ == "__main__":
+    unittest.main()
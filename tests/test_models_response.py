@@ -0,0 +1,113 @@
+import os
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+os.environ.setdefault("CUSTOMCHATFREE_NO_WARMUP", "1")
+
+from services import models_response
+
+
+def _completion(content):
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class _FakeAsyncClient:
+    """Stands in for AsyncOpenAI; replies per OpenRouter model ID from `replies`."""
+
+    def __init__(self, replies: dict):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self._replies = replies
+
+    async def _create(self, model, **kwargs):
+        return self._replies[model]
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FitToContextTest(unittest.TestCase):
+    WINDOW = models_response.RESERVED_OUTPUT_TOKENS + 1000
+    BUDGET = 1000
+    TEXT = "The quick brown fox jumps over the lazy dog. "
+
+    def assertWithinBudget(self, messages):
+        self.assertLessEqual(sum(models_response._message_tokens(m) for m in messages), self.BUDGET)
+
+    def test_prompt_that_fits_is_unchanged(self):
+        messages = models_response.ModelsData._build_messages(self.TEXT, "You are a chef.")
+        self.assertIs(models_response._fit_to_context(self.WINDOW, messages), messages)
+
+    def test_oversized_question_keeps_its_end(self):
+        history = [{"role": "user", "content": self.TEXT * 50}, {"role": "assistant", "content": self.TEXT * 50}]
+        question = self.TEXT * 500 + "What should I cook?"
+        messages = history + models_response.ModelsData._build_messages(question, "You are a chef.")
+
+        fitted = models_response._fit_to_context(self.WINDOW, messages)
+
+        self.assertWithinBudget(fitted)
+        self.assertEqual([m["role"] for m in fitted], ["system", "user"])  # History dropped first
+        self.assertEqual(fitted[0]["content"], "You are a chef.")
+        self.assertTrue(fitted[-1]["content"].endswith("What should I cook?"))
+
+    def test_oversized_system_prompt_leaves_the_question(self):
+        system = "You are a chef. " + self.TEXT * 500
+        messages = models_response.ModelsData._build_messages("What should I cook?", system)
+
+        fitted = models_response._fit_to_context(self.WINDOW, messages)
+
+        self.assertWithinBudget(fitted)
+        self.assertEqual(fitted[-1]["content"], "What should I cook?")
+        self.assertTrue(fitted[0]["content"].startswith("You are a chef."))
+        self.assertLess(len(fitted[0]["content"]), len(system))
+
+    def test_image_message_keeps_the_image_part(self):
+        image = {"type": "image_url", "image_url": {"url": "data:image/png;base64,AAAA"}}
+        messages = models_response.ModelsData._build_messages(self.TEXT * 500 + "What is this?", None,
+                                                               image["image_url"]["url"])
+
+        fitted = models_response._fit_to_context(self.WINDOW, messages)
+
+        self.assertWithinBudget(fitted)
+        text, image_part = fitted[-1]["content"]
+        self.assertTrue(text["text"].endswith("What is this?"))
+        self.assertEqual(image_part, image)
+        # The caller's messages are left as they were
+        self.assertEqual(len(messages[-1]["content"][0]["text"]), len(self.TEXT * 500 + "What is this?"))
+
+
+class AskManyTest(unittest.TestCase):
+    def setUp(self):
+        patches = [
+            mock.patch.object(models_response, "DISK_CACHE_PATH", None),
+            mock.patch.object(models_response, "_response_cache", {}),
+            mock.patch.object(models_response, "_load_api_key", lambda: {"openroute_api_key": "test"}),
+            mock.patch.object(models_response, "get_client", lambda api_key=None: None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.models = models_response.ModelsData()
+
+    def test_one_failed_model_keeps_the_other_replies(self):
+        specs = models_response.ModelsData.MODELS
+        client = _FakeAsyncClient({
+            specs["kimi"].id: _completion("kimi reply"),
+            # OpenRouter answers some provider errors with HTTP 200 and no choices
+            specs["qwq_32b"].id: SimpleNamespace(choices=None),
+            specs["mistral_nemo"].id: _completion("nemo reply"),
+        })
+        with mock.patch.object(models_response, "get_async_client", lambda api_key=None: client), \
+                self.assertLogs(models_response.logger, "ERROR"):
+            responses = self.models.get_responses("hello", ["kimi", "qwq_32b", "mistral_nemo"])
+
+        self.assertEqual(responses["kimi"], "kimi reply")
+        self.assertEqual(responses["mistral_nemo"], "nemo reply")
+        self.assertTrue(responses["qwq_32b"].startswith(f"[Error contacting {specs['qwq_32b'].label}:"))
+
+
+if __name__ == "__main__":
+    unittest.main()